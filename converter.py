@@ -4,23 +4,185 @@ Web Media Converter - Beautiful Local Media Conversion Tool
 Convert videos to WebM and images to WebP with multiple stunning UI themes
 """
 
-from flask import Flask, request, send_file, jsonify, render_template_string
+from flask import Flask, request, send_file, jsonify, render_template_string, url_for
 import os
 import subprocess
 from pathlib import Path
 import tempfile
+import atexit
 import base64
 from werkzeug.utils import secure_filename
+from werkzeug.serving import make_server
+from werkzeug.debug import DebuggedApplication
+from werkzeug.middleware.proxy_fix import ProxyFix
 import json
 import uuid
+import zipfile
+import urllib.request
+import urllib.error
+import sqlite3
+import shutil
+import threading
+import hashlib
+import re
+import time
+import random
+import math
+import sys
+import signal
+import socket
+import argparse
+import multiprocessing
+import select
+import struct
+import ctypes
+import ctypes.util
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size per file
 
 UPLOAD_FOLDER = tempfile.mkdtemp()
+
+
+def remove_upload_folder(owner=os.getpid()):
+    # Only the process that created the folder removes it; forked batch
+    # workers share it with their parent
+    if os.getpid() == owner:
+        shutil.rmtree(UPLOAD_FOLDER, ignore_errors=True)
+
+
+# Every entry point (serve, worker, batch, watch, probe, library use) leaves
+# nothing behind in the temp directory
+atexit.register(remove_upload_folder)
 ALLOWED_VIDEO_EXTENSIONS = {'.mp4', '.avi', '.mov', '.mkv', '.flv', '.wmv', '.m4v', '.mpg', '.mpeg', '.3gp', '.webm'}
 ALLOWED_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif', '.svg', '.webp'}
 
+# Quality-targeted encoding: sample size used for trial encodes, and how many
+# search results to remember (keyed by content hash and encode settings)
+QUALITY_SAMPLE_SECONDS = 4
+QUALITY_SAMPLE_TILE = 512
+QUALITY_CACHE_SIZE = 1024
+
+# Scores a quality target can ask for, per metric (PSNR in dB)
+TARGET_SCORE_RANGES = {'ssim': (0.0, 1.0), 'psnr': (0.0, 100.0)}
+
+# SVG inputs are rasterized to PNG before encoding, with rsvg-convert when
+# installed (otherwise ffmpeg's librsvg decoder, which ignores DPI). Rasters
+# are cached by content, width and DPI, up to RASTER_CACHE_MB.
+SVG_DEFAULT_WIDTH = 1024
+SVG_MAX_WIDTH = 8192
+SVG_DEFAULT_DPI = 96
+RASTER_CACHE_FOLDER = Path(os.environ.get('CONVERTER_RASTER_CACHE', Path(UPLOAD_FOLDER) / 'rasters'))
+RASTER_CACHE_MB = 512
+
+# Every conversion is recorded in this SQLite database (WAL mode) and can be
+# queried through /history and /stats. Set CONVERTER_HISTORY_DB to an empty
+# string to turn it off.
+HISTORY_DB = os.environ.get('CONVERTER_HISTORY_DB', str(Path(__file__).resolve().parent / 'history.db'))
+
+# What the local ffmpeg supports is probed once per binary and cached here,
+# keyed by the binary's SHA-256, so restarts skip the probe
+CAPABILITY_CACHE = os.environ.get('CONVERTER_CAPABILITY_CACHE',
+                                  str(Path(__file__).resolve().parent / 'ffmpeg-capabilities.json'))
+
+# Queue conversions for worker processes instead of running them in the web
+# process (see DirectoryBroker): a shared directory or an SQLite .db path.
+# Workers holding a job refresh its lease; jobs whose lease runs out go back
+# on the queue.
+BROKER = os.environ.get('CONVERTER_BROKER')
+BROKER_LEASE = float(os.environ.get('CONVERTER_BROKER_LEASE', '60'))
+BROKER_WAIT = float(os.environ.get('CONVERTER_BROKER_WAIT', '900'))
+BROKER_POLL = 0.5
+
+# Converted files are kept for RESULT_TTL seconds so interrupted downloads can
+# resume at /results/<id> instead of converting again. Set
+# CONVERTER_ACCEL_REDIRECT to the internal location a fronting nginx maps onto
+# RESULT_FOLDER to hand the transfer off with X-Accel-Redirect, or
+# CONVERTER_X_SENDFILE=1 for servers that understand X-Sendfile.
+RESULT_FOLDER = Path(UPLOAD_FOLDER) / 'results'
+RESULT_TTL = int(os.environ.get('CONVERTER_RESULT_TTL', '900'))
+RESULT_MIMETYPES = {'.webm': 'video/webm', '.webp': 'image/webp'}
+ACCEL_REDIRECT = os.environ.get('CONVERTER_ACCEL_REDIRECT')
+app.config['USE_X_SENDFILE'] = os.environ.get('CONVERTER_X_SENDFILE') == '1'
+
+# Extra WebP images a video conversion can produce in the same ffmpeg pass:
+# a full-size poster frame, a small thumbnail of it, and a sprite sheet of
+# frames sampled evenly across the video
+VIDEO_EXTRAS = ('poster', 'thumbnail', 'sprite')
+POSTER_MAX_SECONDS = 5
+THUMBNAIL_WIDTH = 320
+SPRITE_COLUMNS = 5
+SPRITE_ROWS = 5
+SPRITE_TILE_WIDTH = 160
+
+# Preview mode returns a quick low-resolution proxy (realtime speed, at most
+# PREVIEW_WIDTH wide, the first PREVIEW_SECONDS of a video) right away and
+# finishes the full conversion in the background
+PREVIEW_WIDTH = 480
+PREVIEW_SECONDS = 5
+
+# Opt-in request tracing: per-stage spans are appended as JSON lines to
+# CONVERTER_TRACE_FILE for a sampled fraction of requests. Requests sent with
+# an "X-Trace: 1" header are always traced while tracing is enabled.
+TRACE_FILE = os.environ.get('CONVERTER_TRACE_FILE')
+TRACE_SAMPLE_RATE = float(os.environ.get('CONVERTER_TRACE_SAMPLE_RATE', '1.0'))
+
+# On SIGTERM or Ctrl-C the server stops taking conversions and waits this many
+# seconds for running ones before killing their ffmpeg processes
+SHUTDOWN_GRACE = float(os.environ.get('CONVERTER_SHUTDOWN_GRACE', '120'))
+
+# Admission control: past any of these limits /convert answers 503 with a
+# Retry-After estimate before reading the upload. 0 turns a limit off. The
+# active-job cap defaults to twice the cores, or with a broker twice the slots
+# of the workers attached to it.
+MAX_ACTIVE_JOBS = int(os.environ.get('CONVERTER_MAX_ACTIVE_JOBS') or -1)
+MAX_QUEUE_WAIT = float(os.environ.get('CONVERTER_MAX_QUEUE_WAIT', '120'))
+MAX_LOAD = float(os.environ.get('CONVERTER_MAX_LOAD', (os.cpu_count() or 1) * 2))
+
+# Per-client quotas: token buckets holding QUOTA_ENCODE_SECONDS of estimated
+# encode time and QUOTA_MB of uploads, refilled evenly over QUOTA_WINDOW
+# seconds. A client is its X-API-Key when the key is one of
+# CONVERTER_API_KEYS (comma-separated), otherwise its address. Buckets live in
+# memory; set CONVERTER_QUOTA_DB to an SQLite path to keep them across
+# restarts. 0 turns a bucket off; both are off by default.
+QUOTA_ENCODE_SECONDS = float(os.environ.get('CONVERTER_QUOTA_ENCODE_SECONDS', '0'))
+QUOTA_MB = float(os.environ.get('CONVERTER_QUOTA_MB', '0'))
+QUOTA_WINDOW = float(os.environ.get('CONVERTER_QUOTA_WINDOW', '3600'))
+QUOTA_DB = os.environ.get('CONVERTER_QUOTA_DB', '')
+QUOTA_MAX_CLIENTS = 10000
+API_KEYS = {key.strip() for key in os.environ.get('CONVERTER_API_KEYS', '').split(',') if key.strip()}
+
+# Behind a reverse proxy every request comes from the proxy's address, so all
+# clients would share one quota. CONVERTER_TRUSTED_PROXIES is how many proxies
+# in front of the app to take X-Forwarded-For (and -Proto, -Host) from; leave
+# it at 0 when clients can reach the app directly, or they can spoof the header.
+TRUSTED_PROXIES = int(os.environ.get('CONVERTER_TRUSTED_PROXIES', '0'))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES,
+                            x_host=TRUSTED_PROXIES)
+
+# Resource limits per job class: cores pinned (and ffmpeg threads), nice and
+# ionice (best-effort class, 0-7) levels, and address-space cap in MB.
+# A value of None leaves that limit off.
+JOB_CLASSES = {
+    'video': {'cores': 4, 'nice': 10, 'ionice': 7, 'memory_mb': 4096},
+    'image': {'cores': 1, 'nice': 5, 'ionice': 4, 'memory_mb': 1024},
+    # Images that have to be decoded at full size before they can be scaled down
+    'image-large': {'cores': 1, 'nice': 10, 'ionice': 7, 'memory_mb': 4096},
+}
+
+# Large images: a decode that would need more than IMAGE_MEMORY_LIMIT_MB
+# (RGBA, counting the copies ffmpeg keeps between decoder, scaler and encoder)
+# is downscaled to fit, during decoding where the codec allows it. Anything
+# over MAX_IMAGE_PIXELS is refused. WebP itself stops at 16383px a side.
+IMAGE_MEMORY_LIMIT_MB = 256
+IMAGE_FRAME_COPIES = 3
+MAX_IMAGE_PIXELS = 200_000_000
+WEBP_MAX_DIMENSION = 16383
+
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
 <html lang="en">
@@ -772,6 +934,23 @@ HTML_TEMPLATE = '''
             box-shadow: 0 4px 20px rgba(102, 126, 234, 0.5);
         }
         
+        .preprocess-option {
+            display: flex;
+            align-items: center;
+            gap: 8px;
+            margin-top: 15px;
+            font-size: 0.9em;
+        }
+        
+        .preprocess-option input[type="number"] {
+            width: 80px;
+            padding: 4px 6px;
+            border-radius: 6px;
+            border: 1px solid #ccc;
+            background: transparent;
+            color: inherit;
+        }
+        
         .progress-container {
             margin-top: 20px;
             padding: 15px;
@@ -918,6 +1097,19 @@ HTML_TEMPLATE = '''
                 <span>Better quality</span>
                 <span>Smaller file</span>
             </div>
+            <label class="preprocess-option">
+                <input type="checkbox" id="browserPreprocess">
+                Shrink images in the browser before uploading
+            </label>
+            <label class="preprocess-option">
+                <input type="checkbox" id="quickPreview">
+                Show a quick preview while the full conversion runs
+            </label>
+            <div class="preprocess-option">
+                Max width:
+                <input type="number" id="maxWidth" min="0" step="100" value="0">
+                px (0 keeps full size)
+            </div>
         </div>
         
         <div class="file-queue" id="fileQueue"></div>
@@ -925,6 +1117,9 @@ HTML_TEMPLATE = '''
         <button class="convert-all-btn" id="convertAllBtn" style="display: none;">
             Convert All Files
         </button>
+        <button class="convert-all-btn" id="downloadAllBtn" style="display: none;">
+            Download All (.zip)
+        </button>
         
         <div class="progress-container" id="progressContainer">
             <div class="overall-progress" id="overallProgress">Processing 0 of 0 files</div>
@@ -984,6 +1179,7 @@ HTML_TEMPLATE = '''
         const fileInput = document.getElementById('fileInput');
         const fileQueue = document.getElementById('fileQueue');
         const convertAllBtn = document.getElementById('convertAllBtn');
+        const downloadAllBtn = document.getElementById('downloadAllBtn');
         const progressContainer = document.getElementById('progressContainer');
         const overallProgress = document.getElementById('overallProgress');
         const overallProgressFill = document.getElementById('overallProgressFill');
@@ -991,6 +1187,9 @@ HTML_TEMPLATE = '''
         const qualityValue = document.getElementById('qualityValue');
         const qualityControl = document.getElementById('qualityControl');
         const qualityToggle = document.getElementById('qualityToggle');
+        const browserPreprocess = document.getElementById('browserPreprocess');
+        const maxWidthInput = document.getElementById('maxWidth');
+        const quickPreview = document.getElementById('quickPreview');
         
         let fileList = [];
         let processedCount = 0;
@@ -1099,10 +1298,31 @@ HTML_TEMPLATE = '''
                     updateOverallProgress();
                 }
             }
+            // Full conversions behind previews finish in the background
+            await Promise.all(fileList.map(fileObj => fileObj.finishing).filter(Boolean));
             
             isProcessing = false;
             convertAllBtn.disabled = false;
             convertAllBtn.textContent = 'All files converted!';
+            if (fileList.some(fileObj => fileObj.resultId)) {
+                downloadAllBtn.style.display = 'block';
+            }
+        });
+        
+        // Download every result as one zip. A form post lets the browser
+        // stream the archive to disk instead of into page memory.
+        downloadAllBtn.addEventListener('click', () => {
+            const form = document.createElement('form');
+            form.method = 'POST';
+            form.action = '/results/archive';
+            const ids = document.createElement('input');
+            ids.type = 'hidden';
+            ids.name = 'ids';
+            ids.value = fileList.filter(fileObj => fileObj.resultId).map(fileObj => fileObj.resultId).join(',');
+            form.appendChild(ids);
+            document.body.appendChild(form);
+            form.submit();
+            form.remove();
         });
         
         function updateOverallProgress() {
@@ -1112,6 +1332,133 @@ HTML_TEMPLATE = '''
             overallProgressFill.style.width = percentage + '%';
         }
         
+        // Browser-side image pre-processing: decode and downscale off the main
+        // thread, then encode WebP directly when the browser supports it, or
+        // fall back to a lossless PNG for the server to encode
+        const preprocessWorkerSource = `
+            self.onmessage = async (e) => {
+                const { id, file, maxWidth, quality } = e.data;
+                try {
+                    const bitmap = await createImageBitmap(file);
+                    let width = bitmap.width;
+                    let height = bitmap.height;
+                    if (maxWidth > 0 && width > maxWidth) {
+                        height = Math.round(height * maxWidth / width);
+                        width = maxWidth;
+                    }
+                    const canvas = new OffscreenCanvas(width, height);
+                    canvas.getContext('2d').drawImage(bitmap, 0, 0, width, height);
+                    bitmap.close();
+                    
+                    // Browsers without a WebP encoder silently return PNG
+                    let blob = await canvas.convertToBlob({ type: 'image/webp', quality: quality });
+                    const encoded = blob.type === 'image/webp';
+                    if (!encoded) {
+                        blob = await canvas.convertToBlob({ type: 'image/png' });
+                    }
+                    self.postMessage({ id, blob, encoded });
+                } catch (error) {
+                    self.postMessage({ id, error: String(error) });
+                }
+            };
+        `;
+        const preprocessTypes = ['image/jpeg', 'image/png', 'image/bmp', 'image/webp'];
+        const preprocessJobs = {};
+        let preprocessWorker = null;
+        
+        function canPreprocess(file) {
+            return typeof OffscreenCanvas !== 'undefined' &&
+                typeof createImageBitmap !== 'undefined' &&
+                typeof Worker !== 'undefined' &&
+                preprocessTypes.includes(file.type);
+        }
+        
+        function preprocessImage(fileObj) {
+            if (!preprocessWorker) {
+                const source = new Blob([preprocessWorkerSource], { type: 'text/javascript' });
+                preprocessWorker = new Worker(URL.createObjectURL(source));
+                preprocessWorker.onmessage = (e) => {
+                    const job = preprocessJobs[e.data.id];
+                    delete preprocessJobs[e.data.id];
+                    if (e.data.error) {
+                        job.reject(new Error(e.data.error));
+                    } else {
+                        job.resolve(e.data);
+                    }
+                };
+            }
+            return new Promise((resolve, reject) => {
+                preprocessJobs[fileObj.id] = { resolve, reject };
+                preprocessWorker.postMessage({
+                    id: fileObj.id,
+                    file: fileObj.file,
+                    maxWidth: parseInt(maxWidthInput.value) || 0,
+                    quality: (100 - parseInt(qualitySlider.value)) / 100
+                });
+            });
+        }
+        
+        // A busy server answers 503; wait as long as its Retry-After says
+        // (or back off exponentially without one) before trying again
+        async function postWithBackoff(formData, statusElement) {
+            for (let attempt = 0; ; attempt++) {
+                const response = await fetch('/convert', {
+                    method: 'POST',
+                    body: formData
+                });
+                // 503: server busy; 429: this client's quota needs to refill
+                if ((response.status !== 503 && response.status !== 429) || attempt >= 8) {
+                    return response;
+                }
+                const retryAfter = parseInt(response.headers.get('Retry-After'));
+                const delay = isNaN(retryAfter) ? Math.min(60, 2 ** attempt) : retryAfter;
+                // Jitter keeps several open tabs from retrying in lockstep
+                const seconds = Math.ceil(delay * (1 + Math.random() * 0.2));
+                const reason = response.status === 429 ? 'Quota used up' : 'Server busy';
+                statusElement.textContent = `${reason}, retrying in ${seconds}s...`;
+                await new Promise(resolve => setTimeout(resolve, seconds * 1000));
+                statusElement.textContent = 'Converting...';
+            }
+        }
+        
+        // Preview mode: show the quick proxy, then poll the background job
+        // and offer the full conversion once it is done
+        async function finishFromPreview(fileObj, response) {
+            const fileElement = document.getElementById(fileObj.id);
+            const statusElement = fileElement.querySelector('.file-status');
+            const actionElement = document.getElementById(`action-${fileObj.id}`);
+            const jobUrl = response.headers.get('X-Job-URL');
+            
+            try {
+                const previewUrl = URL.createObjectURL(await response.blob());
+                const previewLink = `<a href="${previewUrl}" target="_blank" class="download-link">Preview</a>`;
+                statusElement.textContent = 'Preview ready, converting full quality...';
+                actionElement.innerHTML = previewLink;
+                
+                let job;
+                do {
+                    await new Promise(resolve => setTimeout(resolve, 2000));
+                    job = await (await fetch(jobUrl)).json();
+                } while (job.status === 'running');
+                if (job.status !== 'done') {
+                    throw new Error(job.error || 'Conversion failed');
+                }
+                
+                const reduction = ((fileObj.originalSize - job.size) / fileObj.originalSize * 100).toFixed(1);
+                fileElement.classList.remove('processing');
+                fileElement.classList.add('completed');
+                statusElement.textContent = `Converted! Saved ${reduction}%`;
+                actionElement.innerHTML = `${previewLink} <a href="${job.url}" download="${job.download_name}" class="download-link">Download</a>`;
+                fileObj.resultId = job.id;
+                fileObj.status = 'completed';
+            } catch (error) {
+                fileElement.classList.remove('processing');
+                fileElement.classList.add('error');
+                statusElement.textContent = 'Conversion failed';
+                fileObj.status = 'error';
+            }
+        }
+        
         async function convertFile(fileObj) {
             const fileElement = document.getElementById(fileObj.id);
             const statusElement = fileElement.querySelector('.file-status');
@@ -1120,39 +1467,58 @@ HTML_TEMPLATE = '''
             fileElement.classList.add('processing');
             statusElement.textContent = 'Converting...';
             
+            // Upload the browser-prepared image only when it is actually smaller
+            let upload = fileObj.file;
+            let clientEncoded = false;
+            if (browserPreprocess.checked && canPreprocess(fileObj.file)) {
+                statusElement.textContent = 'Preparing in browser...';
+                try {
+                    const prepared = await preprocessImage(fileObj);
+                    if (prepared.blob.size < fileObj.file.size) {
+                        const name = fileObj.file.name;
+                        const stem = name.lastIndexOf('.') > 0 ? name.slice(0, name.lastIndexOf('.')) : name;
+                        const extension = prepared.encoded ? '.webp' : '.png';
+                        upload = new File([prepared.blob], stem + extension, { type: prepared.blob.type });
+                        clientEncoded = prepared.encoded;
+                    }
+                } catch (error) {
+                    // Fall back to uploading the original
+                }
+                statusElement.textContent = 'Converting...';
+            }
+            
+            // link=1: the server keeps the result and answers with its URL,
+            // so nothing converted is held in browser memory
             const formData = new FormData();
-            formData.append('file', fileObj.file);
+            formData.append('file', upload);
             formData.append('quality', qualitySlider.value);
+            formData.append('link', '1');
+            if (clientEncoded) {
+                formData.append('client_encoded', '1');
+            } else if (quickPreview.checked) {
+                formData.append('preview', '1');
+            }
             
             try {
-                const response = await fetch('/convert', {
-                    method: 'POST',
-                    body: formData
-                });
+                const response = await postWithBackoff(formData, statusElement);
                 
                 if (!response.ok) {
                     throw new Error('Conversion failed');
                 }
+                if (response.headers.get('X-Preview')) {
+                    fileObj.finishing = finishFromPreview(fileObj, response);
+                    return;
+                }
                 
-                const blob = await response.blob();
-                const filename = response.headers.get('Content-Disposition').split('filename=')[1].replace(/"/g, '');
-                const fileSizeHeader = response.headers.get('X-File-Size');
-                const convertedSize = fileSizeHeader ? parseInt(fileSizeHeader) : blob.size;
-                
-                const url = URL.createObjectURL(blob);
-                const reduction = ((fileObj.originalSize - convertedSize) / fileObj.originalSize * 100).toFixed(1);
+                const result = await response.json();
+                const reduction = ((fileObj.originalSize - result.size) / fileObj.originalSize * 100).toFixed(1);
                 
                 fileElement.classList.remove('processing');
                 fileElement.classList.add('completed');
                 statusElement.textContent = `Converted! Saved ${reduction}%`;
-                actionElement.innerHTML = `<a href="${url}" download="${filename}" class="download-link">Download</a>`;
-                
-                // Auto-download
-                const a = document.createElement('a');
-                a.href = url;
-                a.download = filename;
-                a.click();
+                actionElement.innerHTML = `<a href="${result.url}" download="${result.download_name}" class="download-link">Download</a>`;
                 
+                fileObj.resultId = result.id;
                 fileObj.status = 'completed';
             } catch (error) {
                 fileElement.classList.remove('processing');
@@ -1395,125 +1761,3581 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
-@app.route('/')
-def index():
-    return render_template_string(HTML_TEMPLATE)
+class Trace:
+    """Timed spans for one request, written as a single JSON line when finished"""
 
-@app.route('/convert', methods=['POST'])
-def convert():
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file provided'}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
+    write_lock = threading.Lock()
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.started = time.time()
+        self.clock = time.perf_counter()
+        self.spans = []
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time a stage; the yielded dict can be filled in with more attributes"""
+        span = {'name': name, 'start_ms': round((time.perf_counter() - self.clock) * 1000, 3)}
+        span.update(attrs)
+        try:
+            yield span
+        finally:
+            span['duration_ms'] = round((time.perf_counter() - self.clock) * 1000 - span['start_ms'], 3)
+            self.spans.append(span)
+
+    def finish(self, **attrs):
+        record = {
+            'trace_id': self.id,
+            'name': self.name,
+            'timestamp': self.started,
+            'duration_ms': round((time.perf_counter() - self.clock) * 1000, 3),
+            'spans': self.spans,
+        }
+        record.update(attrs)
+        with self.write_lock:
+            with open(TRACE_FILE, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+
+class NullTrace:
+    """Stand-in used when a request is not sampled"""
+
+    id = None
+
+    @contextmanager
+    def span(self, name, **attrs):
+        yield {}
+
+    def finish(self, **attrs):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+def start_trace(name, force=False):
+    if TRACE_FILE and (force or random.random() < TRACE_SAMPLE_RATE):
+        return Trace(name)
+    return NULL_TRACE
+
+
+class CoreAllocator:
+    """Hands out core sets so concurrent encodes don't share cores"""
+
+    def __init__(self):
+        if hasattr(os, 'sched_getaffinity'):
+            self.cores = sorted(os.sched_getaffinity(0))
+        else:
+            self.cores = list(range(os.cpu_count() or 1))
+        self.load = {core: 0 for core in self.cores}
+        self.lock = threading.Lock()
+
+    def acquire(self, count):
+        count = max(1, min(count, len(self.cores)))
+        with self.lock:
+            # Least-loaded cores first, lowest index on ties so sets stay contiguous
+            cores = sorted(self.cores, key=lambda core: (self.load[core], core))[:count]
+            for core in cores:
+                self.load[core] += 1
+        return sorted(cores)
+
+    def release(self, cores):
+        with self.lock:
+            for core in cores:
+                self.load[core] -= 1
+
+
+core_allocator = CoreAllocator()
+
+# Limits are applied with wrapper tools rather than preexec_fn, which is not
+# safe to use from Flask's threaded request handlers
+TASKSET = shutil.which('taskset')
+NICE = shutil.which('nice')
+IONICE = shutil.which('ionice')
+PRLIMIT = shutil.which('prlimit')
+
+
+def limited_command(cmd, limits, cores):
+    """Prefix cmd with whichever limit wrappers are available on this host"""
+    prefix = []
+    if TASKSET and cores:
+        prefix += [TASKSET, '-c', ','.join(str(core) for core in cores)]
+    if NICE and limits.get('nice') is not None:
+        prefix += [NICE, '-n', str(limits['nice'])]
+    if IONICE and limits.get('ionice') is not None:
+        prefix += [IONICE, '-c', '2', '-n', str(limits['ionice'])]
+    if PRLIMIT and limits.get('memory_mb') is not None:
+        prefix += [PRLIMIT, f"--as={limits['memory_mb'] * 1024 * 1024}"]
+    return prefix + cmd
+
+
+# Shutdown state: running conversions and their ffmpeg processes, so a
+# stopping server can wait for the first and kill what is left of the second
+draining = threading.Event()
+shutdown_deadline = None
+active_requests = 0
+active_condition = threading.Condition()
+active_processes = set()
+active_processes_lock = threading.Lock()
+
+
+@contextmanager
+def tracked_request():
+    """Count a conversion as in flight for the duration of the block"""
+    global active_requests
+    with active_condition:
+        active_requests += 1
+    try:
+        yield
+    finally:
+        with active_condition:
+            active_requests -= 1
+            active_condition.notify_all()
+
+
+# Moving average of recent encode times, used to estimate waits
+recent_job_seconds = 10.0
+
+
+def note_job_seconds(seconds):
+    global recent_job_seconds
+    recent_job_seconds = 0.8 * recent_job_seconds + 0.2 * seconds
+
+
+def admission_check():
+    """(reason, retry_after) when a new conversion should be refused, else None"""
+    if BROKER:
+        # Jobs queued by every front end, run by whichever workers are attached
+        active, capacity = get_broker().capacity()
+        if not capacity:
+            return 'no workers attached to the broker', BROKER_LEASE
+    else:
+        active, capacity = active_requests, len(core_allocator.cores)
     
-    # Get quality setting
-    quality = int(request.form.get('quality', 30))
+    limit = MAX_ACTIVE_JOBS if MAX_ACTIVE_JOBS >= 0 else capacity * 2
+    if limit and active >= limit:
+        # Running jobs finish at about active / recent_job_seconds per second
+        excess = active - limit + 1
+        return 'too many active conversions', excess * recent_job_seconds / active
     
-    # Save uploaded file
-    filename = secure_filename(file.filename)
-    input_path = Path(UPLOAD_FOLDER) / f"{uuid.uuid4()}_{filename}"
-    file.save(str(input_path))
+    # Encode time a new job would spend behind the ones already running
+    wait = recent_job_seconds * max(0, active - capacity + 1) / capacity
+    if MAX_QUEUE_WAIT and wait > MAX_QUEUE_WAIT:
+        return 'queue wait too long', wait - MAX_QUEUE_WAIT
     
-    # Get original file size
-    original_size = input_path.stat().st_size
+    # With a broker this host only relays uploads, so its load says little
+    if MAX_LOAD and not BROKER and hasattr(os, 'getloadavg'):
+        load = os.getloadavg()[0]
+        if load > MAX_LOAD:
+            # The one-minute average decays by 1/e a minute once load stops
+            return 'load average too high', 60 * math.log(load / MAX_LOAD)
+    return None
+
+
+quota_buckets = {}
+quota_lock = threading.Lock()
+quota_local = threading.local()
+
+QUOTA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS quotas (
+    client TEXT PRIMARY KEY,
+    seconds REAL NOT NULL,
+    bytes REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+def quota_limits():
+    """Bucket sizes by name; a bucket of 0 is not enforced"""
+    return {'seconds': QUOTA_ENCODE_SECONDS, 'bytes': QUOTA_MB * 1024 * 1024}
+
+
+def quotas_enabled():
+    return any(quota_limits().values())
+
+
+def quota_db():
+    """This thread's connection to the quota database, or None when disabled"""
+    if not QUOTA_DB:
+        return None
+    db = getattr(quota_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(QUOTA_DB, timeout=10, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(QUOTA_SCHEMA)
+        quota_local.db = db
+    return db
+
+
+def quota_client():
+    """Who the current request is charged to"""
+    key = request.headers.get('X-API-Key')
+    if key in API_KEYS:
+        # Keys are not stored or echoed, only a fingerprint of them
+        return 'key:' + hashlib.sha256(key.encode()).hexdigest()[:16]
+    return 'ip:' + (request.remote_addr or 'unknown')
+
+
+def quota_bucket(client):
+    """client's bucket, refilled up to now; call with quota_lock held"""
+    bucket = quota_buckets.get(client)
+    if bucket is None:
+        row = None
+        try:
+            db = quota_db()
+            if db is not None:
+                row = db.execute('SELECT seconds, bytes, updated FROM quotas WHERE client = ?',
+                                 (client,)).fetchone()
+        except sqlite3.Error as e:
+            app.logger.warning('Could not load quota: %s', e)
+        limits = quota_limits()
+        bucket = dict(row) if row else {'seconds': limits['seconds'], 'bytes': limits['bytes'],
+                                        'updated': time.time()}
+        if len(quota_buckets) >= QUOTA_MAX_CLIENTS:
+            # Full buckets are the same as new ones, so they can go
+            for name in [name for name, other in quota_buckets.items()
+                         if all(other[key] >= limit for key, limit in limits.items())]:
+                del quota_buckets[name]
+        quota_buckets[client] = bucket
     
-    # Determine file type and output format
-    file_ext = input_path.suffix.lower()
+    now = time.time()
+    for name, limit in quota_limits().items():
+        if limit:
+            bucket[name] = min(limit, bucket[name] + limit * (now - bucket['updated']) / QUOTA_WINDOW)
+    bucket['updated'] = now
+    return bucket
+
+
+def quota_status(client):
+    with quota_lock:
+        return dict(quota_bucket(client))
+
+
+def charge_quota(client, seconds=0, size=0):
+    """Take encode seconds and bytes from client's bucket. It may go below
+    zero: the next request then waits until it has refilled."""
+    with quota_lock:
+        bucket = quota_bucket(client)
+        bucket['seconds'] -= seconds
+        bucket['bytes'] -= size
+        try:
+            db = quota_db()
+            if db is not None:
+                db.execute('INSERT OR REPLACE INTO quotas (client, seconds, bytes, updated) '
+                           'VALUES (?, ?, ?, ?)',
+                           (client, bucket['seconds'], bucket['bytes'], bucket['updated']))
+        except sqlite3.Error as e:
+            app.logger.warning('Could not save quota: %s', e)
+
+
+def quota_wait(client):
+    """Seconds until an exhausted bucket of client's is above zero again, or
+    None when the client may start a conversion"""
+    bucket = quota_status(client)
+    waits = [-bucket[name] * QUOTA_WINDOW / limit for name, limit in quota_limits().items()
+             if limit and bucket[name] <= 0]
+    return max(waits) if waits else None
+
+
+def estimate_encode_seconds(input_path, kind, engine, params):
+    """Expected encode time for a conversion, charged to the client's quota up front"""
+    threads = 1
+    if engine['threading'] == 'multi':
+        threads = min(JOB_CLASSES[kind]['cores'], len(core_allocator.cores))
+    work = encode_work(input_path, kind, start=params['start'], duration=params['duration'])
+    return estimate_seconds(engine, params['speed'] or DEFAULT_SPEED, work, threads)
+
+
+def drain_jobs(grace=SHUTDOWN_GRACE):
+    """Refuse new conversions, wait up to grace seconds for running ones, then
+    kill leftover ffmpeg processes"""
+    global shutdown_deadline
+    shutdown_deadline = time.monotonic() + grace
+    draining.set()
+    with active_condition:
+        if active_requests:
+            print(f"Waiting up to {grace:g}s for {active_requests} conversion(s) to finish")
+        while active_requests and time.monotonic() < shutdown_deadline:
+            active_condition.wait(max(0, shutdown_deadline - time.monotonic()))
     
+    kill_active_processes()
+    # Give the killed requests a moment to answer; the upload folder goes
+    # when the process exits
+    with active_condition:
+        active_condition.wait_for(lambda: not active_requests, timeout=5)
+
+
+def skip_drain():
+    """End drain_jobs()'s wait now, e.g. on a second Ctrl-C"""
+    global shutdown_deadline
+    shutdown_deadline = time.monotonic()
+    with active_condition:
+        active_condition.notify_all()
+
+
+def kill_active_processes():
+    with active_processes_lock:
+        leftover = list(active_processes)
+    for process in leftover:
+        # Marked so run_job() does not mistake the SIGKILL for the OOM killer
+        process.shutdown_kill = True
+        process.kill()
+    if leftover:
+        print(f"Killed {len(leftover)} unfinished ffmpeg process(es)")
+
+
+def run_job(cmd, job_class, timeout=300, threads=None, trace=NULL_TRACE):
+    """Run an ffmpeg command pinned and capped according to its job class"""
+    limits = JOB_CLASSES[job_class]
+    cores = core_allocator.acquire(threads or limits['cores'])
+    process = None
     try:
-        if file_ext in ALLOWED_VIDEO_EXTENSIONS:
-            # Convert video to WebM
-            output_path = input_path.with_suffix('.webm')
-            
-            # Calculate CRF value based on quality reduction percentage
-            crf = int(10 + (quality * 0.6))  # Maps 10-90% to CRF 16-64
-            
-            cmd = [
-                'ffmpeg', '-i', str(input_path),
-                '-c:v', 'libvpx-vp9',
-                '-crf', str(crf),
-                '-b:v', '0',
-                '-cpu-used', '5',
-                '-c:a', 'libopus',
-                '-b:a', '128k',
-                '-y',
-                str(output_path)
-            ]
-            
-        elif file_ext in ALLOWED_IMAGE_EXTENSIONS:
-            # Convert image to WebP
-            output_path = input_path.with_suffix('.webp')
-            
-            # Calculate quality value (inverse of reduction percentage)
-            webp_quality = 100 - quality
-            
-            cmd = [
-                'ffmpeg', '-i', str(input_path),
-                '-c:v', 'libwebp',
-                '-quality', str(webp_quality),
-                '-preset', 'default',
-                '-y',
-                str(output_path)
-            ]
+        full_cmd = limited_command(cmd, limits, cores)
+        with trace.span('spawn', cmd=full_cmd, cores=cores):
+            process = subprocess.Popen(full_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                       text=True)
+        with active_processes_lock:
+            active_processes.add(process)
+        with trace.span('encode') as span:
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.communicate()
+                span['timeout'] = True
+                raise
+            span['returncode'] = process.returncode
+        if getattr(process, 'shutdown_kill', False):
+            raise ConversionError(FAILURE_MESSAGES['interrupted'], 'interrupted')
+        return subprocess.CompletedProcess(full_cmd, process.returncode, stdout, stderr)
+    finally:
+        if process is not None:
+            with active_processes_lock:
+                active_processes.discard(process)
+        core_allocator.release(cores)
+
+
+# Encoder engines. Each one declares which kind of input it handles, its
+# output container, how it threads, its speed presets and a command builder
+# taking a job dict (input, output, quality, speed, threads).
+ENGINES = {}
+DEFAULT_SPEED = 'balanced'
+
+# Relative encode time of each speed preset, fastest first. With a deadline
+# the slowest preset expected to finish in time is used.
+SPEED_COST = {'realtime': 0.25, 'fast': 0.5, 'balanced': 1.0, 'archival': 4.0}
+SPEEDS = list(SPEED_COST)
+
+# Engines tried in order for each policy; the first available one wins
+ENGINE_POLICIES = {
+    'speed': {'video': ['vp9'], 'image': ['webp']},
+    'balanced': {'video': ['vp9'], 'image': ['webp-auto', 'webp']},
+    'size': {'video': ['av1-svt', 'av1-aom', 'vp9'], 'image': ['webp-auto', 'webp']},
+}
+
+# webp-auto trial-encodes a copy at most WEBP_TRIAL_WIDTH wide both ways and
+# keeps lossless when it is at most WEBP_LOSSLESS_RATIO times the lossy size
+# (graphics, screenshots), near-lossless up to WEBP_NEAR_LOSSLESS_RATIO, and
+# lossy beyond that (photos)
+WEBP_TRIAL_WIDTH = 512
+WEBP_LOSSLESS_RATIO = 1.1
+WEBP_NEAR_LOSSLESS_RATIO = 1.8
+
+
+def register_engine(name, kind, suffix, build, speeds, threading, requires=None, sources=None,
+                    tunable=True, rate=10.0, prepare=None):
+    """Add an encoder engine to the registry.
+
+    threading is 'multi' or 'single' and decides how many cores a job gets.
+    requires names an ffmpeg encoder ('encoder') or external binary ('binary')
+    the engine needs; sources restricts the input extensions it accepts.
+    tunable is False for engines whose output ignores the quality setting.
+    rate is a first guess at throughput in megapixels per second per thread
+    at the balanced speed; measured encodes replace it. prepare, if given, is
+    called with the job before building and returns fields to add to it.
+    """
+    ENGINES[name] = {
+        'name': name,
+        'kind': kind,
+        'suffix': suffix,
+        'build': build,
+        'speeds': speeds,
+        'threading': threading,
+        'requires': requires or {},
+        'sources': sources,
+        'tunable': tunable,
+        'rate': rate,
+        'prepare': prepare,
+    }
+
+
+# Filters each video extra needs, on top of the encoders engines declare
+EXTRA_FILTERS = {
+    'poster': {'split', 'select'},
+    'thumbnail': {'split', 'select', 'scale'},
+    'sprite': {'split', 'select', 'scale', 'tile'},
+}
+
+_capabilities = None
+_capabilities_expire = 0
+# A failed probe is tried again after this many seconds
+CAPABILITY_RETRY = 60
+
+
+def probe_ffmpeg(binary):
+    """Version string, encoder names and filter names of an ffmpeg binary"""
+    def lines(*args):
+        result = subprocess.run([binary, '-hide_banner', *args],
+                                capture_output=True, text=True, timeout=30)
+        return [line.split() for line in result.stdout.splitlines() if line.strip()]
+    
+    version = lines('-version')[0]
+    encoders = lines('-encoders')
+    # The list starts after the legend (" V..... = Video") and its ------ rule
+    rule = next((i for i, words in enumerate(encoders) if words[0].startswith('---')), -1)
+    return {
+        'version': version[2] if len(version) > 2 else None,
+        # Encoder lines look like " V....D libvpx-vp9  libvpx VP9"
+        'encoders': sorted({words[1] for words in encoders[rule + 1:]
+                            if len(words) > 1 and len(words[0]) == 6}),
+        # Filter lines look like " ... ssim  VV->V  Calculate the SSIM..."
+        'filters': sorted({words[1] for words in lines('-filters')
+                           if len(words) > 2 and '->' in words[2]}),
+    }
+
+
+def ffmpeg_capabilities():
+    """What the ffmpeg on PATH supports, plus this host's thread counts.
+
+    The probe runs once per binary; its results are cached in
+    CAPABILITY_CACHE keyed by the binary's SHA-256, so a restart (or another
+    host sharing the file) with the same build skips it.
+    """
+    global _capabilities, _capabilities_expire
+    if _capabilities is not None and time.monotonic() < _capabilities_expire:
+        return _capabilities
+    capabilities = {'binary': shutil.which('ffmpeg'), 'sha256': None, 'version': None,
+                    'encoders': [], 'filters': []}
+    if capabilities['binary']:
+        digest = file_digest(capabilities['binary'])
+        capabilities['sha256'] = digest
+        try:
+            cache = json.loads(Path(CAPABILITY_CACHE).read_text())
+        except (OSError, ValueError):
+            cache = {}
+        # Entries from before the legend was skipped list '=' as an encoder
+        if digest in cache and '=' not in cache[digest]['encoders']:
+            capabilities.update(cache[digest])
         else:
-            os.remove(input_path)
-            return jsonify({'error': f'Unsupported file format: {file_ext}'}), 400
-        
-        # Run conversion
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        
-        if result.returncode != 0:
-            os.remove(input_path)
-            if output_path.exists():
-                os.remove(output_path)
-            return jsonify({'error': 'Conversion failed'}), 500
-        
-        # Get converted file size
-        converted_size = output_path.stat().st_size
-        
-        # Get output filename without UUID
-        output_filename = Path(filename).stem + output_path.suffix
-        
-        # Send converted file
-        response = send_file(
-            str(output_path),
-            as_attachment=True,
-            download_name=output_filename,
-            mimetype='application/octet-stream'
-        )
-        
-        # Add file size to response headers
-        response.headers['X-File-Size'] = str(converted_size)
-        
-        # Clean up after sending
-        @response.call_on_close
-        def cleanup():
             try:
-                os.remove(input_path)
-                os.remove(output_path)
-            except:
-                pass
-        
-        return response
-        
-    except subprocess.TimeoutExpired:
-        if input_path.exists():
-            os.remove(input_path)
-        if output_path.exists():
-            os.remove(output_path)
-        return jsonify({'error': 'Conversion timeout - file too large or complex'}), 500
-    except Exception as e:
-        if input_path.exists():
-            os.remove(input_path)
-        if 'output_path' in locals() and output_path.exists():
-            os.remove(output_path)
-        return jsonify({'error': str(e)}), 500
+                probed = probe_ffmpeg(capabilities['binary'])
+            except (OSError, IndexError, subprocess.TimeoutExpired):
+                probed = None
+            if probed and probed['version']:
+                capabilities.update(probed)
+                cache[digest] = probed
+                try:
+                    partial = Path(f'{CAPABILITY_CACHE}.{os.getpid()}.tmp')
+                    partial.write_text(json.dumps(cache, indent=2))
+                    os.replace(partial, CAPABILITY_CACHE)
+                except OSError:
+                    pass
+    capabilities['threads'] = os.cpu_count() or 1
+    capabilities['usable_threads'] = len(core_allocator.cores)
+    _capabilities = capabilities
+    # Without ffmpeg, or when the probe failed, look again in a while instead
+    # of holding on to an empty encoder list
+    _capabilities_expire = math.inf if capabilities['version'] else time.monotonic() + CAPABILITY_RETRY
+    return capabilities
 
-if __name__ == '__main__':
-    print("Web Media Converter with Beautiful Themes")
-    print("Running at: http://127.0.0.1:8080")
-    print("Convert multiple media files locally with style!")
-    print("Multiple file support enabled!")
-    app.run(host='127.0.0.1', debug=True, port=8080, threaded=True)
\ No newline at end of file
+
+def ffmpeg_encoders():
+    """Names of the encoders compiled into the local ffmpeg; empty when it
+    could not be probed"""
+    return set(ffmpeg_capabilities()['encoders'])
+
+
+def missing_filters(names):
+    """The filters in names the local ffmpeg lacks; none when it could not be probed"""
+    filters = ffmpeg_capabilities()['filters']
+    return set(names) - set(filters) if filters else set()
+
+
+def capability_report():
+    """ffmpeg build, host threads and which engines can run, for /health and probe"""
+    capabilities = ffmpeg_capabilities()
+    encoders = set(capabilities['encoders'])
+    needed_encoders = {engine['requires']['encoder'] for engine in ENGINES.values()
+                       if 'encoder' in engine['requires']} | {'libopus', 'libvorbis'}
+    needed_filters = set().union(*EXTRA_FILTERS.values(), {'ssim', 'psnr'})
+    engines = {name: engine_available(name) for name in ENGINES}
+    return {
+        'ffmpeg': {key: capabilities[key] for key in ('binary', 'version', 'sha256')},
+        'threads': capabilities['threads'],
+        'usable_threads': capabilities['usable_threads'],
+        'encoders': {name: name in encoders for name in sorted(needed_encoders)},
+        'filters': {name: not missing_filters([name]) for name in sorted(needed_filters)},
+        'engines': engines,
+        'kinds': {kind: any(available for name, available in engines.items()
+                            if ENGINES[name]['kind'] == kind)
+                  for kind in ('video', 'image')},
+    }
+
+
+def engine_available(name):
+    requires = ENGINES[name]['requires']
+    if 'binary' in requires and not shutil.which(requires['binary']):
+        return False
+    if 'encoder' in requires:
+        capabilities = ffmpeg_capabilities()
+        if not capabilities['binary']:
+            return False
+        # An ffmpeg that could not be probed is assumed to have the encoder,
+        # as missing_filters() assumes for filters
+        encoders = capabilities['encoders']
+        if encoders and requires['encoder'] not in encoders:
+            return False
+    return True
+
+
+def engine_accepts(name, kind, file_ext):
+    engine = ENGINES[name]
+    return engine['kind'] == kind and (engine['sources'] is None or file_ext in engine['sources'])
+
+
+def select_engine(kind, file_ext, engine=None, policy='balanced'):
+    """Pick the engine named by the caller, or the first usable one for the policy"""
+    if engine:
+        if engine not in ENGINES:
+            raise ValueError(f'Unknown engine: {engine}')
+        if not engine_accepts(engine, kind, file_ext):
+            raise ValueError(f'Engine {engine} cannot convert {file_ext} files')
+        if not engine_available(engine):
+            raise ValueError(f'Engine {engine} is not available on this server')
+        return ENGINES[engine]
+    if policy not in ENGINE_POLICIES:
+        raise ValueError(f'Unknown policy: {policy}')
+    for name in ENGINE_POLICIES[policy][kind]:
+        if engine_accepts(name, kind, file_ext) and engine_available(name):
+            return ENGINES[name]
+    raise ValueError(f'No {kind} engine available for policy {policy}')
+
+
+def extra_filter(name, job):
+    """Filter chain turning one branch of the decoded video into an extra image"""
+    poster = f"select=gte(t\\,{job['poster_time']})"
+    if name == 'poster':
+        return poster
+    if name == 'thumbnail':
+        return f'{poster},scale={THUMBNAIL_WIDTH}:-2'
+    # Keep one frame per interval, then lay them out in a grid
+    return (f"select=isnan(prev_selected_t)+gte(t-prev_selected_t\\,{job['sprite_interval']}),"
+            f'scale={SPRITE_TILE_WIDTH}:-2,tile={SPRITE_COLUMNS}x{SPRITE_ROWS}')
+
+
+def input_args(job):
+    """Input-side trim options. -ss before -i seeks by keyframe index instead of
+    decoding from the start; ffmpeg then drops the frames up to the exact
+    start time, so the cut stays frame-accurate. -lowres has the JPEG
+    decoder produce a 1/2, 1/4 or 1/8 size image directly. A tolerant job
+    (retrying corrupt input) skips damaged packets instead of stopping."""
+    args = []
+    if job.get('tolerant'):
+        args += ['-err_detect', 'ignore_err', '-fflags', '+discardcorrupt+genpts']
+    if job.get('lowres'):
+        args += ['-lowres', str(job['lowres'])]
+    if job.get('start'):
+        args += ['-ss', str(job['start'])]
+    if job.get('duration'):
+        args += ['-t', str(job['duration'])]
+    return args + ['-i', str(job['input'])]
+
+
+def ffmpeg_command(job, codec_args):
+    extras = job.get('extras')
+    if not extras:
+        scale = ['-vf', 'scale={}:{}'.format(*job['scale'])] if job.get('scale') else []
+        return ['ffmpeg'] + input_args(job) + scale + codec_args + ['-y', str(job['output'])]
+    
+    # Decode once and split the frames between the main encode and each extra image
+    labels = [f'extra{i}' for i in range(len(extras))]
+    main = 'full' if job.get('scale') else 'main'
+    graph = [f'[0:v]split={len(extras) + 1}[{main}]' + ''.join(f'[{label}]' for label in labels)]
+    if job.get('scale'):
+        # Only the main encode is scaled; the extras have sizes of their own
+        graph.append('[full]scale={}:{}[main]'.format(*job['scale']))
+    extra_outputs = []
+    for label, (name, path) in zip(labels, extras.items()):
+        graph.append(f'[{label}]{extra_filter(name, job)}[{label}out]')
+        extra_outputs += ['-map', f'[{label}out]', '-frames:v', '1',
+                          '-c:v', 'libwebp', '-quality', '80', str(path)]
+    return (['ffmpeg', '-y'] + input_args(job) +
+            ['-filter_complex', ';'.join(graph),
+             '-map', '[main]', '-map', '0:a?']
+            + codec_args + [str(job['output'])] + extra_outputs)
+
+
+def video_crf(quality):
+    return min(63, int(10 + (quality * 0.6)))  # Maps 10-90% to CRF 16-63
+
+
+def opus_audio():
+    # Vorbis is the other audio codec WebM allows; without either, drop audio
+    encoders = ffmpeg_encoders()
+    if 'libopus' in encoders or not encoders:
+        return ['-c:a', 'libopus', '-b:a', '128k']
+    if 'libvorbis' in encoders:
+        return ['-c:a', 'libvorbis', '-b:a', '128k']
+    return ['-an']
+
+
+def build_vp9(job):
+    return ffmpeg_command(job, [
+        '-c:v', 'libvpx-vp9',
+        '-crf', str(video_crf(job['quality'])),
+        '-b:v', '0',
+        *ENGINES['vp9']['speeds'][job['speed']],
+        '-row-mt', '1',
+        '-threads', str(job['threads']),
+    ] + opus_audio())
+
+
+def build_av1_svt(job):
+    return ffmpeg_command(job, [
+        '-c:v', 'libsvtav1',
+        '-crf', str(video_crf(job['quality'])),
+        *ENGINES['av1-svt']['speeds'][job['speed']],
+        '-svtav1-params', f"lp={job['threads']}",
+    ] + opus_audio())
+
+
+def build_av1_aom(job):
+    return ffmpeg_command(job, [
+        '-c:v', 'libaom-av1',
+        '-crf', str(video_crf(job['quality'])),
+        '-b:v', '0',
+        *ENGINES['av1-aom']['speeds'][job['speed']],
+        '-row-mt', '1',
+        '-tiles', '2x2',
+        '-threads', str(job['threads']),
+    ] + opus_audio())
+
+
+def build_webp(job):
+    return ffmpeg_command(job, [
+        '-c:v', 'libwebp',
+        '-quality', str(100 - job['quality']),  # Inverse of reduction percentage
+        '-preset', 'default',
+        *ENGINES['webp']['speeds'][job['speed']],
+    ])
+
+
+def build_webp_lossless(job):
+    return ffmpeg_command(job, [
+        '-c:v', 'libwebp',
+        '-lossless', '1',
+        *ENGINES['webp-lossless']['speeds'][job['speed']],
+    ])
+
+
+def build_webp_near_lossless(job):
+    # ffmpeg's libwebp wrapper has no near-lossless switch, so use cwebp.
+    # Lower -near_lossless values allow more preprocessing (100 is lossless).
+    return ['cwebp', '-quiet',
+            '-near_lossless', str(100 - job['quality']),
+            *ENGINES['webp-near-lossless']['speeds'][job['speed']],
+            *(['-resize', *map(str, job['scale'])] if job.get('scale') else []),
+            '-mt', str(job['input']), '-o', str(job['output'])]
+
+
+def has_alpha(pix_fmt):
+    """Whether an ffmpeg pixel format carries alpha (rgba, yuva420p, ya8, pal8...)"""
+    return 'a' in (pix_fmt or '').replace('gray', '')
+
+
+def cwebp_usable(path):
+    return (shutil.which('cwebp') is not None
+            and Path(path).suffix.lower() in ENGINES['webp-near-lossless']['sources'])
+
+
+def prepare_webp_auto(job):
+    """Pick lossless, near-lossless or lossy WebP for an image.
+
+    Flat-color graphics compress about as well losslessly as lossy while
+    photos do not, so trial encodes of a small copy tell them apart. The copy
+    is decoded once, under the job's class, and both trials read it. Lossy
+    images with alpha get an alpha quality tied to the quality setting.
+    """
+    info = probe_media(job['input'])
+    width, height = job.get('scale') or (info['width'], info['height'])
+    output = Path(job['output'])
+    trial = {'input': job['input'], 'quality': job['quality'], 'speed': 'fast',
+             'threads': 1, 'tolerant': job.get('tolerant')}
+    sample = output.with_name(f'{output.stem}.trial-source.png')
+    try:
+        if width and height and width > WEBP_TRIAL_WIDTH:
+            size = (WEBP_TRIAL_WIDTH, max(2, round(height * WEBP_TRIAL_WIDTH / width / 2) * 2))
+            cmd = ['ffmpeg'] + input_args(dict(trial, lowres=job.get('lowres'))) + [
+                '-vf', 'scale={}:{}'.format(*size), '-frames:v', '1', '-y', str(sample)]
+            result = run_job(cmd, job.get('job_class', 'image'), timeout=120)
+            if result.returncode != 0 or not sample.exists():
+                return {'mode': 'lossy'}
+            trial = dict(trial, input=sample, tolerant=None)
+        
+        sizes = {}
+        for mode, build in (('lossless', build_webp_lossless), ('lossy', build_webp)):
+            trial['output'] = output.with_name(f'{output.stem}.trial-{mode}.webp')
+            try:
+                result = run_job(build(trial), 'image', timeout=60)
+                if result.returncode == 0 and trial['output'].exists():
+                    sizes[mode] = trial['output'].stat().st_size
+            finally:
+                remove_files([trial['output']])
+    finally:
+        remove_files([sample])
+    if not sizes.get('lossless') or not sizes.get('lossy'):
+        return {'mode': 'lossy'}
+    
+    ratio = sizes['lossless'] / sizes['lossy']
+    plan = {'mode': 'lossy'}
+    # cwebp ignores -lowres, so a JPEG planned to decode shrunk stays on ffmpeg
+    cwebp = not job.get('lowres') and cwebp_usable(job['input'])
+    if ratio <= WEBP_LOSSLESS_RATIO:
+        plan['mode'] = 'lossless'
+    elif ratio <= WEBP_NEAR_LOSSLESS_RATIO and cwebp:
+        plan['mode'] = 'near-lossless'
+    elif has_alpha(info['pix_fmt']) and cwebp:
+        plan['alpha_quality'] = webp_alpha_quality(job['quality'])
+    return plan
+
+
+def webp_alpha_quality(quality):
+    # Alpha edges show artifacts sooner than color does
+    return max(50, 100 - quality // 2)
+
+
+def build_webp_auto(job):
+    mode = job.get('mode', 'lossy')
+    if mode == 'lossless':
+        return build_webp_lossless(job)
+    if mode == 'near-lossless':
+        return build_webp_near_lossless(job)
+    if job.get('alpha_quality') is None:
+        return build_webp(job)
+    # ffmpeg's libwebp wrapper always keeps alpha lossless; cwebp can compress it
+    return ['cwebp', '-quiet',
+            '-q', str(100 - job['quality']),
+            '-alpha_q', str(job['alpha_quality']),
+            *ENGINES['webp-near-lossless']['speeds'][job['speed']],
+            *(['-resize', *map(str, job['scale'])] if job.get('scale') else []),
+            '-mt', str(job['input']), '-o', str(job['output'])]
+
+
+register_engine('vp9', 'video', '.webm', build_vp9, threading='multi', rate=20.0,
+                requires={'encoder': 'libvpx-vp9'}, speeds={
+                    'realtime': ['-deadline', 'realtime', '-cpu-used', '8'],
+                    'fast': ['-deadline', 'good', '-cpu-used', '6'],
+                    'balanced': ['-cpu-used', '5'],
+                    'archival': ['-deadline', 'good', '-cpu-used', '1'],
+                })
+register_engine('av1-svt', 'video', '.webm', build_av1_svt, threading='multi', rate=15.0,
+                requires={'encoder': 'libsvtav1'}, speeds={
+                    'realtime': ['-preset', '12'],
+                    'fast': ['-preset', '10'],
+                    'balanced': ['-preset', '8'],
+                    'archival': ['-preset', '4'],
+                })
+register_engine('av1-aom', 'video', '.webm', build_av1_aom, threading='multi', rate=3.0,
+                requires={'encoder': 'libaom-av1'}, speeds={
+                    'realtime': ['-usage', 'realtime', '-cpu-used', '8'],
+                    'fast': ['-cpu-used', '6'],
+                    'balanced': ['-cpu-used', '4'],
+                    'archival': ['-cpu-used', '2'],
+                })
+register_engine('webp', 'image', '.webp', build_webp, threading='single', rate=10.0,
+                requires={'encoder': 'libwebp'}, speeds={
+                    'realtime': ['-compression_level', '0'],
+                    'fast': ['-compression_level', '2'],
+                    'balanced': ['-compression_level', '4'],
+                    'archival': ['-compression_level', '6'],
+                })
+register_engine('webp-lossless', 'image', '.webp', build_webp_lossless, threading='single',
+                requires={'encoder': 'libwebp'}, tunable=False, rate=2.0, speeds={
+                    'realtime': ['-compression_level', '0'],
+                    'fast': ['-compression_level', '2'],
+                    'balanced': ['-compression_level', '4'],
+                    'archival': ['-compression_level', '6'],
+                })
+register_engine('webp-near-lossless', 'image', '.webp', build_webp_near_lossless, threading='multi',
+                requires={'binary': 'cwebp'}, rate=2.0,
+                sources={'.png', '.jpg', '.jpeg', '.tiff', '.tif', '.webp', '.svg'}, speeds={
+                    'realtime': ['-m', '0'],
+                    'fast': ['-m', '2'],
+                    'balanced': ['-m', '4'],
+                    'archival': ['-m', '6'],
+                })
+register_engine('webp-auto', 'image', '.webp', build_webp_auto, threading='single',
+                requires={'encoder': 'libwebp'}, rate=8.0, prepare=prepare_webp_auto, speeds={
+                    'realtime': ['-compression_level', '0'],
+                    'fast': ['-compression_level', '2'],
+                    'balanced': ['-compression_level', '4'],
+                    'archival': ['-compression_level', '6'],
+                })
+
+
+
+def file_digest(path):
+    """SHA-256 of a file's contents, read in 1MB chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Probe results by (path, mtime, size): one request asks about its input from
+# the quota estimate, trimming, extras, the encode and the history record
+probe_cache = OrderedDict()
+probe_cache_lock = threading.Lock()
+PROBE_CACHE_SIZE = 256
+
+
+def probe_media(path):
+    """Duration, dimensions, frame rate and pixel format of the first video stream"""
+    try:
+        stat = os.stat(path)
+        key = (str(path), stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        key = None
+    with probe_cache_lock:
+        if key in probe_cache:
+            probe_cache.move_to_end(key)
+            return dict(probe_cache[key])
+    
+    try:
+        result = subprocess.run([
+            'ffprobe', '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'stream=codec_name,width,height,pix_fmt,avg_frame_rate:format=duration',
+            '-of', 'json',
+            str(path)
+        ], capture_output=True, text=True, timeout=30)
+        data = json.loads(result.stdout or '{}')
+    except (OSError, subprocess.TimeoutExpired, ValueError):
+        data = {}
+    stream = (data.get('streams') or [{}])[0]
+    duration = data.get('format', {}).get('duration')
+    # avg_frame_rate is a fraction like 30000/1001, or 0/0 when unknown
+    numerator, _, denominator = (stream.get('avg_frame_rate') or '0/0').partition('/')
+    try:
+        fps = float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        fps = 0.0
+    info = {
+        'codec': stream.get('codec_name'),
+        'width': stream.get('width'),
+        'height': stream.get('height'),
+        'pix_fmt': stream.get('pix_fmt'),
+        'fps': fps or None,
+        'duration': float(duration) if duration not in (None, 'N/A') else None,
+    }
+    # A failed probe is not kept, so the next caller tries again
+    if key is not None and data:
+        with probe_cache_lock:
+            probe_cache[key] = info
+            if len(probe_cache) > PROBE_CACHE_SIZE:
+                probe_cache.popitem(last=False)
+    return dict(info)
+
+
+def parse_timestamp(value):
+    """Seconds from '90', '90.5', '1:30' or '00:01:30.5'; None for empty values"""
+    if value in (None, ''):
+        return None
+    parts = str(value).split(':')
+    # Plain digits only: float() would also take '-5', 'nan' and 'inf'
+    if len(parts) > 3 or not all(re.fullmatch(r'\d+(\.\d+)?', part) for part in parts):
+        raise ValueError(f'Invalid time: {value}')
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def clip_length(input_path, start=None, duration=None):
+    """Length in seconds of the part of a video a job will encode"""
+    total = probe_media(input_path)['duration']
+    if total is None:
+        return duration or 0
+    remaining = max(0, total - (start or 0))
+    return min(remaining, duration) if duration else remaining
+
+
+# Measured throughput per engine (see register_engine's rate)
+encode_rates = {}
+
+
+def encode_work(input_path, kind, scale=None, start=None, duration=None):
+    """Megapixels an encode has to process: every frame of the video clip, or
+    the image, at the size it is scaled to"""
+    info = probe_media(input_path)
+    if scale:
+        width, height = scale
+    else:
+        width, height = info['width'] or 1920, info['height'] or 1080
+    work = width * height / 1e6
+    if kind == 'video':
+        work *= clip_length(input_path, start, duration) * (info['fps'] or 30)
+    return work
+
+
+def estimate_seconds(engine, speed, work, threads):
+    rate = encode_rates.get(engine['name'], engine['rate'])
+    return work * SPEED_COST[speed] / (rate * threads)
+
+
+def choose_speed(engine, work, deadline, threads):
+    """Slowest (best compressing) preset expected to finish within deadline
+    seconds; realtime when none is"""
+    for speed in reversed(SPEEDS):
+        if estimate_seconds(engine, speed, work, threads) <= deadline:
+            return speed
+    return SPEEDS[0]
+
+
+def note_encode_rate(engine, speed, work, threads, seconds):
+    rate = work * SPEED_COST[speed] / (max(seconds, 0.01) * threads)
+    previous = encode_rates.get(engine['name'], engine['rate'])
+    encode_rates[engine['name']] = 0.7 * previous + 0.3 * rate
+
+
+quality_cache = OrderedDict()
+quality_cache_lock = threading.Lock()
+
+
+def make_quality_sample(input_path, kind, workdir, start=None, duration=None, image_plan=None):
+    """Cut a lossless reference sample: a clip from the middle of a video, or a center tile of an image.
+
+    start and duration restrict the video sample to a trimmed range;
+    image_plan (see plan_image_decode) takes the tile from the downscaled image.
+    """
+    job_class = kind
+    if kind == 'video':
+        clip_start = start or 0
+        clip_duration = clip_length(input_path, start, duration)
+        start = max(clip_start, clip_start + clip_duration / 2 - QUALITY_SAMPLE_SECONDS / 2)
+        sample = Path(workdir) / 'sample.mkv'
+        cmd = [
+            'ffmpeg', '-ss', str(start), '-i', str(input_path),
+            '-t', str(QUALITY_SAMPLE_SECONDS),
+            '-map', '0:v:0', '-c:v', 'ffv1', '-an',
+            '-y', str(sample)
+        ]
+    else:
+        sample = Path(workdir) / 'sample.png'
+        tile = QUALITY_SAMPLE_TILE
+        crop = f'crop=min(iw\\,{tile}):min(ih\\,{tile})'
+        plan = image_plan or {}
+        if plan.get('scale'):
+            crop = 'scale={}:{},'.format(*plan['scale']) + crop
+        job_class = plan.get('job_class', kind)
+        cmd = [
+            'ffmpeg', *(['-lowres', str(plan['lowres'])] if plan.get('lowres') else []),
+            '-i', str(input_path),
+            '-vf', crop,
+            '-frames:v', '1',
+            '-y', str(sample)
+        ]
+    result = run_job(cmd, job_class, timeout=120)
+    if result.returncode != 0:
+        raise RuntimeError('Could not extract a quality sample')
+    return sample
+
+
+def parse_target(metric, score):
+    """Validated quality target: score as a float (None without one).
+    Raises ValueError for an unknown metric or a score outside its range."""
+    if metric not in TARGET_SCORE_RANGES:
+        raise ValueError(f'Unknown quality metric: {metric}')
+    if score is None or score == '':
+        return None
+    try:
+        score = float(score)
+    except (TypeError, ValueError):
+        raise ValueError(f'Target score must be a number: {score}')
+    low, high = TARGET_SCORE_RANGES[metric]
+    if not low < score <= high:
+        raise ValueError(f'{metric.upper()} target must be above {low:g} and at most {high:g}')
+    return score
+
+
+def measure_quality(distorted, reference, metric, kind):
+    """Score distorted against reference with ffmpeg's ssim or psnr filter,
+    run under kind's job class like the trial encodes"""
+    graph = (f'[0:v]setpts=PTS-STARTPTS[d];[1:v]setpts=PTS-STARTPTS[r];'
+             f'[d][r]scale2ref[d2][r2];[d2][r2]{metric}')
+    result = run_job([
+        'ffmpeg', '-hide_banner', '-i', str(distorted), '-i', str(reference),
+        '-lavfi', graph, '-f', 'null', '-'
+    ], kind, timeout=120)
+    # "SSIM Y:... All:0.981 (17.2)" or "PSNR y:... average:41.3 min:..."
+    pattern = r'All:([\d.]+)' if metric == 'ssim' else r'average:([\d.]+|inf)'
+    match = re.search(pattern, result.stderr)
+    if not match:
+        raise RuntimeError(f'Could not measure {metric.upper()}')
+    return float(match.group(1))
+
+
+def search_quality(input_path, kind, engine, metric, target, speed=DEFAULT_SPEED, threads=1,
+                   digest=None, start=None, duration=None, image_plan=None, plan=None):
+    """Largest quality reduction whose trial encode still scores at least target.
+
+    Binary-searches the slider range (10-90 in steps of 5) on a short sample
+    and caches the answer per content hash and encode settings. plan holds
+    the fields an engine's prepare step chose (e.g. the WebP mode), applied
+    to every trial. Returns (quality, score); falls back to the best-quality
+    setting when nothing in range meets the target.
+    """
+    plan = plan or {}
+    key = (digest or file_digest(input_path), engine['name'], speed, metric, target, start, duration,
+           plan.get('mode'), plan.get('alpha_quality') is not None)
+    with quality_cache_lock:
+        if key in quality_cache:
+            quality_cache.move_to_end(key)
+            return quality_cache[key]
+
+    workdir = tempfile.mkdtemp(dir=UPLOAD_FOLDER)
+    try:
+        sample = make_quality_sample(input_path, kind, workdir, start, duration, image_plan)
+        scores = {}
+
+        def trial(quality):
+            output = Path(workdir) / f'trial_{quality}{engine["suffix"]}'
+            trial_job = dict(plan, input=sample, output=output, quality=quality, speed=speed,
+                             threads=threads)
+            if trial_job.get('alpha_quality') is not None:
+                trial_job['alpha_quality'] = webp_alpha_quality(quality)
+            cmd = engine['build'](trial_job)
+            result = run_job(cmd, kind, timeout=120, threads=threads)
+            if result.returncode != 0:
+                raise RuntimeError('Trial encode failed')
+            scores[quality] = measure_quality(output, sample, metric, kind)
+            return scores[quality]
+
+        best = None
+        low, high = 2, 18  # Slider positions, i.e. quality 10-90 in steps of 5
+        while low <= high:
+            mid = (low + high) // 2
+            if trial(mid * 5) >= target:
+                best = mid * 5
+                low = mid + 1
+            else:
+                high = mid - 1
+        if best is None:
+            best = 10
+            if best not in scores:
+                trial(best)
+        answer = (best, scores[best])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with quality_cache_lock:
+        quality_cache[key] = answer
+        if len(quality_cache) > QUALITY_CACHE_SIZE:
+            quality_cache.popitem(last=False)
+    return answer
+
+class ConversionError(Exception):
+    """A failed encode. failure names its FAILURE_PATTERNS class (or
+    'timeout'); detail holds the tail of ffmpeg's stderr."""
+    
+    def __init__(self, message, failure=None, detail=None):
+        super().__init__(message)
+        self.failure = failure
+        self.detail = detail
+
+
+# ffmpeg failure classes, matched against the tail of stderr in this order.
+# Timeouts come from the job runner rather than from ffmpeg's output.
+FAILURE_PATTERNS = [
+    ('disk-full', re.compile(r'No space left on device|Disk quota exceeded', re.I)),
+    ('out-of-memory', re.compile(r'Cannot allocate memory|Out of memory|bad_alloc|'
+                                 r'Failed to allocate', re.I)),
+    ('missing-encoder', re.compile(r'Unknown encoder|Encoder not found|'
+                                   r'Encoder \(codec .*\) not found', re.I)),
+    ('unsupported-codec', re.compile(r'Unknown decoder|Decoder \(codec .*\) not found|'
+                                     r'not currently supported|Unsupported codec', re.I)),
+    ('corrupt-input', re.compile(r'Invalid data found|moov atom not found|corrupt|'
+                                 r'Error while decoding|Invalid NAL|Truncat|'
+                                 r'error reading header|Header missing|partial file', re.I)),
+]
+
+FAILURE_MESSAGES = {
+    'disk-full': 'Conversion failed - server is out of disk space',
+    'out-of-memory': 'Conversion failed - ran out of memory',
+    'missing-encoder': 'Conversion failed - encoder not available on this server',
+    'unsupported-codec': 'Conversion failed - input codec not supported',
+    'corrupt-input': 'Conversion failed - input is corrupt or truncated',
+    'timeout': 'Conversion timeout - file too large or complex',
+    'interrupted': 'Conversion interrupted - server is shutting down',
+}
+
+# What to change before running a failed job again, tried in order and each
+# at most once: decode past damaged packets, halve the output size, switch
+# to another engine when this ffmpeg lacks the encoder, drop to the fastest
+# speed preset, or free cached files and wait for space. An input codec
+# ffmpeg cannot decode is not retried; no engine can read it either.
+RETRY_POLICIES = {
+    'corrupt-input': ['tolerant-decode'],
+    'out-of-memory': ['downscale'],
+    'missing-encoder': ['other-engine'],
+    'timeout': ['faster-speed'],
+    'disk-full': ['free-space'],
+}
+DISK_FULL_WAIT = 5
+FAILURE_TAIL_LINES = 20
+
+
+def classify_failure(stderr, returncode):
+    """Failure class and stderr tail for a failed ffmpeg run"""
+    tail = '\n'.join((stderr or '').strip().splitlines()[-FAILURE_TAIL_LINES:])
+    for failure, pattern in FAILURE_PATTERNS:
+        if pattern.search(tail):
+            return failure, tail
+    # Killed by a signal: the kernel OOM killer or the address-space limit
+    if returncode is not None and returncode < 0 and -returncode == signal.SIGKILL:
+        return 'out-of-memory', tail
+    return None, tail
+
+
+# Only serializes threads; workers sharing the cache prune it concurrently
+raster_cache_lock = threading.Lock()
+
+
+def prune_raster_cache():
+    """Drop the least recently used rasters once the cache exceeds RASTER_CACHE_MB"""
+    with raster_cache_lock:
+        entries = []
+        for path in RASTER_CACHE_FOLDER.glob('*.png'):
+            if path.name.endswith('.partial.png'):
+                continue  # Still being written
+            try:
+                stat = path.stat()
+            except OSError:
+                continue  # Pruned by another process
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= RASTER_CACHE_MB * 1024 * 1024:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def parse_svg_size(width, dpi):
+    """Validated SVG raster width and DPI as ints, None where not given.
+    Raises ValueError unless each is a whole number from 1 (width up to
+    SVG_MAX_WIDTH)."""
+    sizes = []
+    for name, value in (('width', width), ('DPI', dpi)):
+        if value is None or value == '':
+            sizes.append(None)
+        elif not str(value).isdigit() or int(value) <= 0:
+            raise ValueError(f'SVG {name} must be a positive whole number')
+        else:
+            sizes.append(int(value))
+    if sizes[0] and sizes[0] > SVG_MAX_WIDTH:
+        raise ValueError(f'SVG width must be at most {SVG_MAX_WIDTH}')
+    return tuple(sizes)
+
+
+def rasterize_svg(input_path, width=None, dpi=None, digest=None, trace=NULL_TRACE):
+    """PNG rendering of an SVG at the given width and DPI, from the cache when possible"""
+    width, dpi = parse_svg_size(width, dpi)
+    width = width or SVG_DEFAULT_WIDTH
+    dpi = dpi or SVG_DEFAULT_DPI
+    digest = digest or file_digest(input_path)
+    raster = RASTER_CACHE_FOLDER / f'{digest}_{width}w_{dpi}dpi.png'
+    
+    with trace.span('rasterize', width=width, dpi=dpi) as span:
+        try:
+            os.utime(raster)  # Keep recently used rasters at the front of the LRU
+            span['cache_hit'] = True
+            return raster
+        except FileNotFoundError:
+            span['cache_hit'] = False
+        
+        RASTER_CACHE_FOLDER.mkdir(parents=True, exist_ok=True)
+        partial = raster.with_name(f'{uuid.uuid4().hex}.partial.png')
+        if shutil.which('rsvg-convert'):
+            cmd = ['rsvg-convert', '--width', str(width), '--keep-aspect-ratio',
+                   '--dpi-x', str(dpi), '--dpi-y', str(dpi),
+                   '--format', 'png', '--output', str(partial), str(input_path)]
+        else:
+            cmd = ['ffmpeg', '-width', str(width), '-keep_ar', '1', '-i', str(input_path),
+                   '-frames:v', '1', '-y', str(partial)]
+        result = run_job(cmd, 'image', timeout=120)
+        if result.returncode != 0 or not partial.exists():
+            remove_files([partial])
+            raise ConversionError('Could not rasterize SVG')
+        os.replace(partial, raster)
+    prune_raster_cache()
+    return raster
+
+
+class ImageTooLarge(ConversionError):
+    pass
+
+
+def uses_cwebp(engine):
+    return engine['requires'].get('binary') == 'cwebp'
+
+
+def plan_image_decode(input_path, full_decode=False):
+    """Decide how to decode an image within IMAGE_MEMORY_LIMIT_MB.
+
+    Returns a dict with the JPEG -lowres level, the (width, height) to scale
+    to (None to keep the size) and the job class to run under. full_decode
+    is for encoders such as cwebp that always read the whole bitmap. Raises
+    ImageTooLarge above MAX_IMAGE_PIXELS.
+    """
+    plan = {'lowres': 0, 'scale': None, 'job_class': 'image'}
+    info = probe_media(input_path)
+    width, height = info['width'], info['height']
+    if not width or not height:
+        return plan
+    pixels = width * height
+    if pixels > MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(f'Image is {width}x{height}; the limit is '
+                            f'{MAX_IMAGE_PIXELS // 1_000_000} megapixels')
+    
+    budget = IMAGE_MEMORY_LIMIT_MB * 1024 * 1024 // (4 * IMAGE_FRAME_COPIES)
+    factor = min(1.0, math.sqrt(budget / pixels),
+                 WEBP_MAX_DIMENSION / width, WEBP_MAX_DIMENSION / height)
+    if factor >= 1:
+        return plan
+    plan['scale'] = (max(1, int(width * factor)), max(1, int(height * factor)))
+    if info['codec'] == 'mjpeg' and not full_decode:
+        # Let the decoder skip most of the work; the scale filter does the rest
+        while plan['lowres'] < 3 and 2 ** (plan['lowres'] + 1) <= 1 / factor:
+            plan['lowres'] += 1
+    else:
+        plan['job_class'] = 'image-large'
+    return plan
+
+
+def convert_media(input_path, kind, engine, quality, target_metric=None, target_score=None,
+                  digest=None, trace=NULL_TRACE, output_path=None, timeout=300, extras=(),
+                  start=None, duration=None, svg_width=None, svg_dpi=None, speed=None,
+                  deadline=None, max_width=None):
+    """Encode input_path with engine.
+
+    extras names VIDEO_EXTRAS images to produce in the same pass; start and
+    duration (seconds) trim a video to a clip; svg_width and svg_dpi set the
+    size SVG inputs are rasterized at. speed names a SPEEDS preset; without
+    one, deadline (seconds) picks the slowest preset expected to finish in
+    time. max_width scales the output down to at most that width. Returns a
+    dict with the output path, the quality and speed actually used, for
+    quality-targeted jobs the measured score, and the paths of the extras.
+    """
+    started = time.monotonic()
+    threads = 1
+    if engine['threading'] == 'multi':
+        threads = min(JOB_CLASSES[kind]['cores'], len(core_allocator.cores))
+    
+    # Keep the output name distinct from the input (e.g. WebP -> WebP)
+    if output_path is None:
+        output_path = Path(input_path).with_suffix('.out' + engine['suffix'])
+    
+    # SVGs are encoded from a (cached) raster rendered at the requested size
+    if Path(input_path).suffix.lower() == '.svg':
+        input_path = rasterize_svg(input_path, svg_width, svg_dpi, digest=digest, trace=trace)
+        digest = None
+    
+    # Huge images get downscaled while decoding instead of exhausting memory
+    job_class = kind
+    image_plan = None
+    if kind == 'image':
+        image_plan = plan_image_decode(input_path, full_decode=uses_cwebp(engine))
+        job_class = image_plan['job_class']
+    
+    scale = image_plan['scale'] if image_plan else None
+    if max_width:
+        info = probe_media(input_path)
+        width, height = scale or (info['width'], info['height'])
+        if width and height and width > max_width:
+            # Even dimensions keep 4:2:0 video encoders happy
+            scale = (max_width, max(2, round(height * max_width / width / 2) * 2))
+    
+    job = {
+        'input': input_path,
+        'output': output_path,
+        'quality': quality,
+        'speed': speed,
+        'threads': threads,
+        'start': start,
+        'duration': duration,
+    }
+    if image_plan:
+        job['lowres'] = image_plan['lowres']
+        job['job_class'] = job_class
+    if scale:
+        job['scale'] = scale
+    if extras:
+        length = clip_length(input_path, start, duration)
+        job['extras'] = {name: output_path.with_name(f'{output_path.stem}.{name}.webp')
+                         for name in extras}
+        job['poster_time'] = round(min(POSTER_MAX_SECONDS, length / 10), 3)
+        job['sprite_interval'] = round(max(length / (SPRITE_COLUMNS * SPRITE_ROWS), 0.1), 3)
+    
+    # Engines that adapt to the input (webp-auto) decide before the quality
+    # search, so its trials measure the mode that will really be encoded
+    if engine['prepare']:
+        with trace.span('prepare', engine=engine['name']) as span:
+            job.update(engine['prepare'](job))
+            span['mode'] = job.get('mode')
+    
+    # Optionally replace the slider value with the cheapest setting that
+    # still meets a perceptual quality target. Lossless output ignores it.
+    quality_score = None
+    if target_score is not None and engine['tunable'] and job.get('mode') != 'lossless':
+        with trace.span('quality_search', metric=target_metric, target=target_score) as span:
+            plan = {name: job[name] for name in ('mode', 'alpha_quality') if name in job}
+            quality, quality_score = search_quality(input_path, kind, engine, target_metric,
+                                                    target_score, speed=speed or DEFAULT_SPEED,
+                                                    threads=threads, digest=digest,
+                                                    start=start, duration=duration,
+                                                    image_plan=image_plan, plan=plan)
+            span.update(quality=quality, score=quality_score)
+        job['quality'] = quality
+        if job.get('alpha_quality') is not None:
+            job['alpha_quality'] = webp_alpha_quality(quality)
+    
+    # The deadline covers the whole job, so time spent searching counts
+    work = encode_work(input_path, kind, scale, start, duration)
+    if speed is None:
+        speed = DEFAULT_SPEED
+        if deadline is not None:
+            speed = choose_speed(engine, work, deadline - (time.monotonic() - started), threads)
+    job['speed'] = speed
+    outputs = [output_path] + list(job.get('extras', {}).values())
+    
+    # Failed encodes are classified and retried with the changes their
+    # RETRY_POLICIES entry calls for
+    retries = []
+    while True:
+        cmd = engine['build'](job)
+        try:
+            encode_started = time.monotonic()
+            result = run_job(cmd, job_class, timeout=timeout, threads=threads, trace=trace)
+            if result.returncode == 0:
+                break
+            failure, detail = classify_failure(result.stderr, result.returncode)
+            error = ConversionError(FAILURE_MESSAGES.get(failure, 'Conversion failed'),
+                                    failure, detail)
+        except subprocess.TimeoutExpired as e:
+            failure, error = 'timeout', e
+        except ConversionError:
+            remove_files(outputs)
+            raise
+        remove_files(outputs)
+        step = None
+        if not draining.is_set():
+            # No new attempts once shutdown has started
+            with trace.span('retry', failure=failure) as span:
+                step, engine = plan_retry(failure, job, engine, retries)
+                span['step'] = step
+        if step is None:
+            error.retries = retries
+            raise error
+        app.logger.warning('Encode failed (%s), retrying with %s', failure, step)
+    note_encode_rate(engine, job['speed'], work, threads, time.monotonic() - encode_started)
+    
+    return {'output': output_path, 'quality': quality, 'score': quality_score,
+            'speed': job['speed'], 'mode': job.get('mode'), 'engine': engine['name'],
+            'retries': retries,
+            'extras': job.get('extras', {}), 'scaled_to': job.get('scale'),
+            'media_seconds': clip_length(input_path, start, duration) if kind == 'video' else None}
+
+
+def plan_retry(failure, job, engine, retries):
+    """Apply the next untried RETRY_POLICIES step for failure to job.
+
+    Returns the step, appended to retries, and the engine to run the retry
+    with; the step is None once the policy has nothing left to try.
+    """
+    for step in RETRY_POLICIES.get(failure, []):
+        if step in retries:
+            continue
+        if step == 'tolerant-decode':
+            job['tolerant'] = True
+        elif step == 'downscale':
+            info = probe_media(job['input'])
+            width, height = job.get('scale') or (info['width'], info['height'])
+            if not width or not height or width < 64 or height < 64:
+                continue
+            job['scale'] = (max(2, width // 4 * 2), max(2, height // 4 * 2))
+        elif step == 'other-engine':
+            suffix = Path(job['input']).suffix.lower()
+            fallbacks = [name for policy in ENGINE_POLICIES.values()
+                         for name in policy.get(engine['kind'], [])
+                         if name != engine['name'] and engine_accepts(name, engine['kind'], suffix)
+                         and engine_available(name)
+                         # the job was planned for a -lowres decode cwebp cannot do
+                         and not (job.get('lowres') and uses_cwebp(ENGINES[name]))]
+            if not fallbacks:
+                continue
+            engine = ENGINES[fallbacks[0]]
+            job.pop('mode', None)
+            job.pop('alpha_quality', None)
+            if engine['prepare']:
+                job.update(engine['prepare'](job))
+        elif step == 'faster-speed':
+            if job['speed'] == SPEEDS[0]:
+                continue
+            job['speed'] = SPEEDS[0]
+        elif step == 'free-space':
+            prune_raster_cache()
+            sweep_results()
+            time.sleep(DISK_FULL_WAIT)
+        retries.append(step)
+        return step, engine
+    return None, engine
+
+
+def remove_files(paths):
+    for path in paths:
+        if path.exists():
+            os.remove(path)
+
+
+def media_kind(file_ext):
+    """'video' or 'image' for a supported extension, otherwise None"""
+    if file_ext in ALLOWED_VIDEO_EXTENSIONS:
+        return 'video'
+    if file_ext in ALLOWED_IMAGE_EXTENSIONS:
+        return 'image'
+    return None
+
+
+def trim_range(kind, start=None, end=None, duration=None):
+    """Validate start/end/duration (seconds or [HH:]MM:SS) into (start, duration)"""
+    start, end, duration = parse_timestamp(start), parse_timestamp(end), parse_timestamp(duration)
+    if start is None and end is None and duration is None:
+        return None, None
+    if kind != 'video':
+        raise ValueError('Trimming is only available for videos')
+    if end is not None and duration is not None:
+        raise ValueError('Give either an end time or a duration, not both')
+    if end is not None:
+        if end <= (start or 0):
+            raise ValueError('End time must be after the start time')
+        duration = end - (start or 0)
+    if duration is not None and duration <= 0:
+        raise ValueError('Duration must be positive')
+    return start, duration
+
+
+def convert_file(input_path, output_path=None, quality=30, engine=None, policy='balanced',
+                 target_metric='ssim', target_score=None, timeout=300, extras=(), start=None,
+                 end=None, duration=None, svg_width=None, svg_dpi=None, speed=None,
+                 deadline=None):
+    """Convert one file outside of Flask.
+
+    output_path defaults to the input path with the engine's extension, or
+    with .out before it when that would be the input itself. The encode goes
+    to a temporary name first, so an interrupted run never leaves a truncated
+    output that looks finished. Video extras are written next to the output
+    as <name>.poster.webp etc. Returns a dict with the output path, sizes,
+    engine, quality and elapsed seconds; raises ValueError for unsupported
+    input and ConversionError or subprocess.TimeoutExpired when the encode
+    fails. start/end/duration trim videos, see trim_range();
+    speed and deadline choose the encoder preset, see convert_media().
+    """
+    input_path = Path(input_path)
+    file_ext = input_path.suffix.lower()
+    kind = media_kind(file_ext)
+    if kind is None:
+        raise ValueError(f'Unsupported file format: {file_ext}')
+    engine = select_engine(kind, file_ext, engine=engine, policy=policy)
+    
+    if output_path is None:
+        output_path = input_path.with_suffix(engine['suffix'])
+        if output_path == input_path:
+            output_path = input_path.with_suffix('.out' + engine['suffix'])
+    output_path = Path(output_path)
+    if output_path.resolve() == input_path.resolve():
+        raise ValueError(f'Output would overwrite the input: {input_path}')
+    partial_path = output_path.with_name(output_path.stem + '.partial' + output_path.suffix)
+    
+    if extras and kind != 'video':
+        raise ValueError('Poster, thumbnail and sprite outputs are only available for videos')
+    target_score = parse_target(target_metric, target_score)
+    start, duration = trim_range(kind, start, end, duration)
+    svg_width, svg_dpi = parse_svg_size(svg_width, svg_dpi)
+    if speed is not None and speed not in SPEED_COST:
+        raise ValueError(f'Unknown speed: {speed}')
+    
+    input_size = input_path.stat().st_size
+    started = time.perf_counter()
+    result = convert_media(input_path, kind, engine, quality, target_metric, target_score,
+                           output_path=partial_path, timeout=timeout, extras=extras,
+                           start=start, duration=duration, svg_width=svg_width,
+                           svg_dpi=svg_dpi, speed=speed, deadline=deadline)
+    os.replace(partial_path, output_path)
+    extra_paths = {}
+    for name, path in result['extras'].items():
+        extra_paths[name] = str(output_path.with_name(f'{output_path.stem}.{name}.webp'))
+        os.replace(path, extra_paths[name])
+    return {
+        'output': str(output_path),
+        'extras': extra_paths,
+        'input_size': input_size,
+        'output_size': output_path.stat().st_size,
+        'engine': result['engine'],
+        'quality': result['quality'],
+        'score': result['score'],
+        'speed': result['speed'],
+        'mode': result['mode'],
+        'retries': result['retries'],
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+# Conversions currently running, keyed by content hash and parameters, so
+# identical concurrent submissions share one encode instead of each
+# starting their own
+inflight_jobs = {}
+inflight_lock = threading.Lock()
+
+
+def join_job(key):
+    """Attach to the running job for key, or register a new one.
+
+    Returns (entry, leader); only the leader runs the conversion.
+    """
+    with inflight_lock:
+        entry = inflight_jobs.get(key)
+        if entry is not None:
+            return entry, False
+        entry = {'done': threading.Event(), 'result': None, 'error': None}
+        inflight_jobs[key] = entry
+        return entry, True
+
+
+def finish_job(key, entry):
+    with inflight_lock:
+        inflight_jobs.pop(key, None)
+    entry['done'].set()
+
+
+results = {}
+results_lock = threading.Lock()
+_last_result_sweep = 0
+
+
+def sweep_results():
+    """Delete results past their expiry; runs at most every 30 seconds"""
+    global _last_result_sweep
+    now = time.time()
+    with results_lock:
+        if now - _last_result_sweep < 30:
+            return
+        _last_result_sweep = now
+        expired = [result_id for result_id, result in results.items() if result['expires'] <= now]
+        for result_id in expired:
+            try:
+                os.remove(results.pop(result_id)['path'])
+            except OSError:
+                pass
+
+
+def store_result(output_path, download_name):
+    """Move a finished output into the result store and return its record"""
+    sweep_results()
+    RESULT_FOLDER.mkdir(exist_ok=True)
+    result_id = uuid.uuid4().hex
+    path = RESULT_FOLDER / f'{result_id}{output_path.suffix}'
+    os.replace(output_path, path)
+    result = {
+        'id': result_id,
+        'path': path,
+        'download_name': download_name,
+        'mimetype': RESULT_MIMETYPES.get(path.suffix, 'application/octet-stream'),
+        'size': path.stat().st_size,
+        'expires': time.time() + RESULT_TTL,
+    }
+    with results_lock:
+        results[result_id] = result
+    return result
+
+
+def get_result(result_id):
+    sweep_results()
+    with results_lock:
+        result = results.get(result_id)
+    if result is None or result['expires'] <= time.time():
+        return None
+    return result
+
+
+def send_result(result, download_name=None):
+    """Serve a stored result with Range support, handing the copy to the front end when configured"""
+    download_name = download_name or result['download_name']
+    if ACCEL_REDIRECT:
+        response = app.response_class(mimetype=result['mimetype'])
+        response.headers['X-Accel-Redirect'] = ACCEL_REDIRECT.rstrip('/') + '/' + result['path'].name
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    else:
+        # conditional=True answers Range and If-Range requests; without
+        # X-Sendfile the body goes through wsgi.file_wrapper, which servers
+        # like gunicorn turn into a kernel sendfile
+        response = send_file(
+            str(result['path']),
+            as_attachment=True,
+            download_name=download_name,
+            mimetype=result['mimetype'],
+            conditional=True,
+        )
+    response.headers['X-Result-Id'] = result['id']
+    response.headers['X-Result-URL'] = url_for('download_result', result_id=result['id'])
+    response.headers['X-Result-Expires'] = str(int(result['expires']))
+    return response
+
+
+def reply_with_result(result, download_name=None):
+    """send_result(), or for requests with link=1 just where to fetch the
+    file, so clients like the web UI do not have to hold it in memory"""
+    if request.form.get('link') != '1':
+        return send_result(result, download_name)
+    url = url_for('download_result', result_id=result['id'])
+    response = jsonify({'id': result['id'], 'url': url, 'size': result['size'],
+                        'download_name': download_name or result['download_name'],
+                        'expires': int(result['expires'])})
+    response.headers['X-Result-Id'] = result['id']
+    response.headers['X-Result-URL'] = url
+    response.headers['X-Result-Expires'] = str(int(result['expires']))
+    return response
+
+
+class ZipStream:
+    """Write-only file object that hands zipfile's output to a generator
+    chunk by chunk. It cannot seek, so zipfile writes sizes after each entry."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(entries, chunk_size=1024 * 1024):
+    """Yield a zip archive of (name, path) entries without buffering it.
+    WebM and WebP are already compressed, so entries are stored as is."""
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+        for name, path in entries:
+            info = zipfile.ZipInfo.from_file(path, name)
+            with open(path, 'rb') as source, archive.open(info, 'w') as member:
+                for chunk in iter(lambda: source.read(chunk_size), b''):
+                    member.write(chunk)
+                    yield stream.take()
+            yield stream.take()
+    yield stream.take()
+
+
+# Distributed mode: with CONVERTER_BROKER set, /convert queues jobs in a
+# broker and worker processes (`converter.py worker BROKER`) on any host pull
+# them, run the ffmpeg pipeline and push the outputs back. A broker is a
+# shared directory, or an SQLite database for single-host setups.
+class DirectoryBroker:
+    """Job queue in a shared directory. Each job is a folder moved between
+    pending/, running/ and done/ with atomic renames, so exactly one worker
+    can claim it."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        for state in ('pending', 'running', 'done', 'workers'):
+            (self.root / state).mkdir(parents=True, exist_ok=True)
+
+    def submit(self, job, input_path):
+        job_id = uuid.uuid4().hex
+        staging = self.root / f'.{job_id}'
+        staging.mkdir()
+        shutil.copyfile(input_path, staging / f'input{Path(input_path).suffix}')
+        (staging / 'job.json').write_text(json.dumps(job))
+        os.rename(staging, self.root / 'pending' / job_id)
+        return job_id
+
+    def claim(self, worker, workdir):
+        """Take the oldest pending job; returns (id, job, input path) or None"""
+        self.requeue_expired()
+        pending = []
+        for folder in (self.root / 'pending').iterdir():
+            try:
+                pending.append((folder.stat().st_mtime, folder))
+            except OSError:
+                pass  # claimed by another worker since the listing
+        for mtime, folder in sorted(pending):
+            running = self.root / 'running' / folder.name
+            try:
+                os.rename(folder, running)
+            except OSError:
+                continue  # another worker got there first
+            try:
+                (running / 'worker').write_text(worker)
+                input_path = next(running.glob('input*'))
+                local = Path(workdir) / f'{folder.name}-{input_path.name}'
+                shutil.copyfile(input_path, local)
+                job = json.loads((running / 'job.json').read_text())
+            except (OSError, StopIteration, ValueError):
+                continue  # cancelled or requeued under us
+            return folder.name, job, local
+        return None
+
+    def heartbeat(self, job_id):
+        try:
+            os.utime(self.root / 'running' / job_id / 'worker')
+        except OSError:
+            pass
+
+    def announce(self, worker, slots):
+        """Record that worker is attached with slots jobs at a time"""
+        path = self.root / 'workers' / re.sub(r'[^\w.-]', '_', worker)
+        partial = path.with_name(f'.{path.name}.{uuid.uuid4().hex}')
+        partial.write_text(str(slots))
+        os.replace(partial, path)
+
+    def capacity(self):
+        """(queued or running jobs, slots of workers seen within the lease)"""
+        jobs = sum(1 for state in ('pending', 'running')
+                   for folder in (self.root / state).iterdir())
+        slots = 0
+        for path in (self.root / 'workers').glob('[!.]*'):
+            try:
+                if time.time() - path.stat().st_mtime <= BROKER_LEASE:
+                    slots += int(path.read_text())
+            except (OSError, ValueError):
+                pass
+        return jobs, slots
+
+    def requeue_expired(self):
+        """Put jobs back whose worker stopped sending heartbeats"""
+        for folder in (self.root / 'running').iterdir():
+            try:
+                if time.time() - (folder / 'worker').stat().st_mtime > BROKER_LEASE:
+                    os.rename(folder, self.root / 'pending' / folder.name)
+            except OSError:
+                pass
+
+    def release(self, job_id):
+        try:
+            os.rename(self.root / 'running' / job_id, self.root / 'pending' / job_id)
+        except OSError:
+            pass
+
+    def finish(self, job_id, result, files=None):
+        """Record a job's result (with 'error' set on failure) and its output files"""
+        running = self.root / 'running' / job_id
+        try:
+            for name, path in (files or {}).items():
+                shutil.copyfile(path, running / f'{name}{Path(path).suffix}')
+            (running / 'result.json').write_text(json.dumps(result))
+            os.rename(running, self.root / 'done' / job_id)
+        except FileNotFoundError:
+            pass  # cancelled by the front end, or requeued
+
+    def collect(self, job_id, workdir):
+        """(result, {name: local path}) once the job is done, else None"""
+        done = self.root / 'done' / job_id
+        try:
+            result = json.loads((done / 'result.json').read_text())
+        except (OSError, ValueError):
+            return None
+        files = {}
+        for name in result.get('files', []):
+            source = next(done.glob(f'{name}.*'))
+            files[name] = Path(workdir) / f'{job_id}-{source.name}'
+            shutil.copyfile(source, files[name])
+        shutil.rmtree(done, ignore_errors=True)
+        return result, files
+
+    def cancel(self, job_id):
+        for state in ('pending', 'running', 'done'):
+            shutil.rmtree(self.root / state / job_id, ignore_errors=True)
+
+
+class SQLiteBroker:
+    """Job queue in an SQLite database (WAL mode) with files stored as blobs.
+    SQLite locking is unreliable over network filesystems, so this suits
+    workers on the same host."""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS queue (
+        id TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        created REAL NOT NULL,
+        heartbeat REAL,
+        worker TEXT,
+        job TEXT NOT NULL,
+        result TEXT
+    );
+    CREATE INDEX IF NOT EXISTS queue_state ON queue (state, created);
+    CREATE TABLE IF NOT EXISTS files (
+        job_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        suffix TEXT NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (job_id, name)
+    );
+    CREATE TABLE IF NOT EXISTS workers (
+        name TEXT PRIMARY KEY,
+        slots INTEGER NOT NULL,
+        seen REAL NOT NULL
+    );
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.local = threading.local()
+        self.db().executescript(self.SCHEMA)
+
+    def db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self.local.db = db
+        return db
+
+    def put_file(self, db, job_id, name, path):
+        db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                   (job_id, name, Path(path).suffix, Path(path).read_bytes()))
+
+    def get_file(self, db, job_id, name, workdir):
+        """Write a stored file to workdir; None when the job has been cancelled"""
+        row = db.execute('SELECT suffix, data FROM files WHERE job_id = ? AND name = ?',
+                         (job_id, name)).fetchone()
+        if row is None:
+            return None
+        suffix, data = row
+        local = Path(workdir) / f'{job_id}-{name}{suffix}'
+        local.write_bytes(data)
+        return local
+
+    def submit(self, job, input_path):
+        job_id = uuid.uuid4().hex
+        db = self.db()
+        with db:
+            db.execute('BEGIN')
+            self.put_file(db, job_id, 'input', input_path)
+            db.execute("INSERT INTO queue (id, state, created, job) VALUES (?, 'pending', ?, ?)",
+                       (job_id, time.time(), json.dumps(job)))
+        return job_id
+
+    def claim(self, worker, workdir):
+        db = self.db()
+        with db:
+            # IMMEDIATE takes the write lock up front so two workers cannot
+            # select the same row
+            db.execute('BEGIN IMMEDIATE')
+            db.execute("UPDATE queue SET state = 'pending' WHERE state = 'running' AND heartbeat < ?",
+                       (time.time() - BROKER_LEASE,))
+            row = db.execute("SELECT id, job FROM queue WHERE state = 'pending' "
+                             "ORDER BY created LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE queue SET state = 'running', heartbeat = ?, worker = ? WHERE id = ?",
+                       (time.time(), worker, row[0]))
+        input_path = self.get_file(db, row[0], 'input', workdir)
+        if input_path is None:
+            return None  # cancelled since the claim committed
+        return row[0], json.loads(row[1]), input_path
+
+    def heartbeat(self, job_id):
+        self.db().execute('UPDATE queue SET heartbeat = ? WHERE id = ?', (time.time(), job_id))
+
+    def announce(self, worker, slots):
+        self.db().execute('INSERT OR REPLACE INTO workers VALUES (?, ?, ?)',
+                          (worker, slots, time.time()))
+
+    def capacity(self):
+        db = self.db()
+        jobs = db.execute("SELECT COUNT(*) FROM queue "
+                          "WHERE state IN ('pending', 'running')").fetchone()[0]
+        slots = db.execute('SELECT SUM(slots) FROM workers WHERE seen >= ?',
+                           (time.time() - BROKER_LEASE,)).fetchone()[0]
+        return jobs, slots or 0
+
+    def release(self, job_id):
+        self.db().execute("UPDATE queue SET state = 'pending' WHERE id = ? AND state = 'running'",
+                          (job_id,))
+
+    def finish(self, job_id, result, files=None):
+        db = self.db()
+        with db:
+            # IMMEDIATE so a cancel cannot slip in between the check and the
+            # file inserts and leave orphaned outputs behind
+            db.execute('BEGIN IMMEDIATE')
+            updated = db.execute("UPDATE queue SET state = 'done', result = ? "
+                                 "WHERE id = ? AND state = 'running'",
+                                 (json.dumps(result), job_id)).rowcount
+            if not updated:
+                return  # cancelled by the front end, or requeued
+            for name, path in (files or {}).items():
+                self.put_file(db, job_id, name, path)
+
+    def collect(self, job_id, workdir):
+        db = self.db()
+        row = db.execute("SELECT result FROM queue WHERE id = ? AND state = 'done'",
+                         (job_id,)).fetchone()
+        if row is None:
+            return None
+        result = json.loads(row[0])
+        files = {name: self.get_file(db, job_id, name, workdir) for name in result.get('files', [])}
+        self.cancel(job_id)
+        if None in files.values():
+            return dict(result, error='Job outputs went missing', error_type='ConversionError'), {}
+        return result, files
+
+    def cancel(self, job_id):
+        db = self.db()
+        with db:
+            db.execute('BEGIN')
+            db.execute('DELETE FROM files WHERE job_id = ?', (job_id,))
+            db.execute('DELETE FROM queue WHERE id = ?', (job_id,))
+
+
+def open_broker(spec):
+    """SQLiteBroker for sqlite:PATH or a *.db path, else DirectoryBroker"""
+    if spec.startswith('sqlite:'):
+        return SQLiteBroker(spec[len('sqlite:'):])
+    if spec.endswith('.db'):
+        return SQLiteBroker(spec)
+    return DirectoryBroker(spec)
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = open_broker(BROKER)
+    return _broker
+
+
+def dispatch_media(input_path, kind, engine, quality, target_metric=None, target_score=None,
+                   digest=None, trace=NULL_TRACE, timeout=300, extras=(), start=None,
+                   duration=None, svg_width=None, svg_dpi=None, speed=None, deadline=None,
+                   max_width=None):
+    """convert_media() run by a broker worker; returns the same dict.
+
+    The worker measures deadline from when it starts the job, so time spent
+    waiting in the queue is not taken off the latency budget.
+    """
+    broker = get_broker()
+    job = {
+        'kind': kind, 'engine': engine['name'], 'quality': quality,
+        'target_metric': target_metric, 'target_score': target_score, 'digest': digest,
+        'timeout': timeout, 'extras': list(extras), 'start': start, 'duration': duration,
+        'svg_width': svg_width, 'svg_dpi': svg_dpi, 'speed': speed, 'deadline': deadline,
+        'max_width': max_width,
+    }
+    with trace.span('queue') as span:
+        job_id = broker.submit(job, input_path)
+        span['job'] = job_id
+        give_up_at = time.monotonic() + BROKER_WAIT
+        while True:
+            collected = broker.collect(job_id, Path(input_path).parent)
+            if collected is not None:
+                break
+            if time.monotonic() > give_up_at:
+                broker.cancel(job_id)
+                raise subprocess.TimeoutExpired(['broker', job_id], BROKER_WAIT)
+            time.sleep(BROKER_POLL)
+        result, files = collected
+        span['worker'] = result.get('worker')
+    
+    if result.get('error') is not None:
+        error_types = {'TimeoutExpired': lambda message: subprocess.TimeoutExpired(['ffmpeg'], timeout),
+                       'ImageTooLarge': ImageTooLarge}
+        error = error_types.get(result['error_type'], ConversionError)(result['error'])
+        if isinstance(error, ConversionError):
+            error.failure = result.get('failure')
+            error.detail = result.get('detail')
+        error.retries = result.get('retries', [])
+        raise error
+    return {
+        'output': files.pop('output'),
+        'quality': result['quality'],
+        'score': result['score'],
+        'speed': result['speed'],
+        'mode': result['mode'],
+        'engine': result.get('engine', engine['name']),
+        'retries': result.get('retries', []),
+        'extras': files,
+        'scaled_to': result['scaled_to'],
+        'media_seconds': result['media_seconds'],
+        'encode_seconds': result.get('seconds'),
+    }
+
+
+def is_valid_webp(path):
+    """Check that a client-encoded upload really is a complete, decodable WebP"""
+    with open(path, 'rb') as f:
+        header = f.read(12)
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WEBP':
+        return False
+    # The RIFF size field covers everything after the first 8 bytes
+    if struct.unpack('<I', header[4:8])[0] + 8 > path.stat().st_size:
+        return False
+    info = probe_media(path)
+    return info['codec'] == 'webp' and bool(info['width']) and bool(info['height'])
+
+
+history_local = threading.local()
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL NOT NULL,
+    filename TEXT,
+    kind TEXT,
+    engine TEXT,
+    status TEXT NOT NULL,
+    input_size INTEGER,
+    output_size INTEGER,
+    quality INTEGER,
+    quality_score REAL,
+    encode_seconds REAL,
+    media_seconds REAL,
+    params TEXT,
+    error TEXT,
+    result_id TEXT,
+    failure TEXT,
+    failure_detail TEXT,
+    retries TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created);
+CREATE INDEX IF NOT EXISTS jobs_engine ON jobs (engine, status);
+"""
+
+HISTORY_COLUMNS = ('id', 'created', 'filename', 'kind', 'engine', 'status', 'input_size',
+                   'output_size', 'quality', 'quality_score', 'encode_seconds', 'media_seconds',
+                   'params', 'error', 'result_id', 'failure', 'failure_detail', 'retries')
+
+# Columns added since the first schema, for databases created before them
+HISTORY_MIGRATIONS = [('failure', 'TEXT'), ('failure_detail', 'TEXT'), ('retries', 'TEXT')]
+
+
+def history_db():
+    """This thread's connection to the history database, or None when disabled"""
+    if not HISTORY_DB:
+        return None
+    db = getattr(history_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(HISTORY_DB, timeout=10, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(HISTORY_SCHEMA)
+        existing = {row['name'] for row in db.execute('PRAGMA table_info(jobs)')}
+        for column, column_type in HISTORY_MIGRATIONS:
+            if column not in existing:
+                try:
+                    db.execute(f'ALTER TABLE jobs ADD COLUMN {column} {column_type}')
+                except sqlite3.OperationalError:
+                    pass  # Another thread added it first
+        history_local.db = db
+    return db
+
+
+def record_job(**fields):
+    """Add a row to the job history; a history failure never fails the request"""
+    try:
+        db = history_db()
+        if db is None:
+            return
+        fields['created'] = time.time()
+        for column in ('params', 'retries'):
+            if fields.get(column) is not None:
+                fields[column] = json.dumps(fields[column], default=str)
+        columns = [column for column in HISTORY_COLUMNS if column in fields]
+        db.execute(f"INSERT INTO jobs ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                   [fields[column] for column in columns])
+    except sqlite3.Error as e:
+        app.logger.warning('Could not record job history: %s', e)
+
+
+def save_upload(file, path):
+    """Write an upload to disk, hashing it on the way instead of re-reading it"""
+    digest = hashlib.sha256()
+    with open(path, 'wb') as f:
+        for chunk in iter(lambda: file.stream.read(1024 * 1024), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+@app.before_request
+def admit_conversion():
+    # Checked before the upload body is read, so a stopping or overloaded
+    # server does not take in files it will not convert
+    if request.endpoint != 'convert':
+        return None
+    if draining.is_set():
+        return retry_later('Server is shutting down', 503,
+                           min(300, shutdown_deadline - time.monotonic()))
+    refusal = admission_check()
+    if refusal is not None:
+        return retry_later(f'Server busy: {refusal[0]}', 503, min(300, refusal[1]))
+    
+    # Upload bytes are known from the headers; encode time is charged once
+    # the upload has been probed
+    if quotas_enabled():
+        client = quota_client()
+        wait = quota_wait(client)
+        if wait is not None:
+            return retry_later('Quota used up for now', 429, wait)
+        charge_quota(client, size=request.content_length or 0)
+    return None
+
+
+def retry_later(error, status, retry):
+    response = jsonify({'error': error})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry)))
+    response.headers['Connection'] = 'close'
+    return response
+
+
+@app.after_request
+def add_quota_headers(response):
+    if request.endpoint in ('convert', 'quota') and quotas_enabled():
+        bucket = quota_status(quota_client())
+        for name, limit in quota_limits().items():
+            if limit:
+                header = 'Encode-Seconds' if name == 'seconds' else 'Bytes'
+                response.headers[f'X-Quota-{header}-Limit'] = str(round(limit))
+                response.headers[f'X-Quota-{header}-Remaining'] = str(max(0, math.floor(bucket[name])))
+    return response
+
+
+@app.route('/quota')
+def quota():
+    """The calling client's remaining quota"""
+    if not quotas_enabled():
+        return jsonify({'error': 'Quotas are disabled'}), 404
+    client = quota_client()
+    bucket = quota_status(client)
+    limits = quota_limits()
+    return jsonify({
+        'client': client,
+        'window_seconds': QUOTA_WINDOW,
+        'encode_seconds': {'limit': limits['seconds'], 'remaining': bucket['seconds']}
+                          if limits['seconds'] else None,
+        'bytes': {'limit': limits['bytes'], 'remaining': bucket['bytes']}
+                 if limits['bytes'] else None,
+        'retry_after': quota_wait(client),
+    })
+
+@app.route('/')
+def index():
+    return render_template_string(HTML_TEMPLATE)
+
+@app.route('/convert', methods=['POST'])
+def convert():
+    trace = start_trace('convert', force=request.headers.get('X-Trace') == '1')
+    with tracked_request():
+        response = app.make_response(convert_request(trace))
+    if trace is NULL_TRACE:
+        return response
+    
+    # The send stage lasts until the server closes the response. Werkzeug skips
+    # close callbacks on direct-passthrough (file) responses, so traced
+    # requests give up the file_wrapper fast path to get one.
+    response.direct_passthrough = False
+    response.headers['X-Trace-Id'] = trace.id
+    send_span = trace.span('send', bytes=response.content_length)
+    send_span.__enter__()
+    
+    @response.call_on_close
+    def finish_trace():
+        send_span.__exit__(None, None, None)
+        trace.finish(status=response.status_code)
+    
+    return response
+
+def convert_request(trace):
+    with trace.span('parse', bytes=request.content_length):
+        files = request.files
+    if 'file' not in files:
+        return jsonify({'error': 'No file provided'}), 400
+    
+    file = files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    
+    # Get quality setting
+    quality = int(request.form.get('quality', 30))
+    
+    # Save uploaded file
+    filename = secure_filename(file.filename)
+    input_path = Path(UPLOAD_FOLDER) / f"{uuid.uuid4()}_{filename}"
+    with trace.span('save') as span:
+        digest = save_upload(file, input_path)
+        span['bytes'] = input_path.stat().st_size
+    
+    # Determine file type and output format
+    file_ext = input_path.suffix.lower()
+    kind = media_kind(file_ext)
+    if kind is None:
+        os.remove(input_path)
+        return jsonify({'error': f'Unsupported file format: {file_ext}'}), 400
+    
+    # Images already encoded to WebP in the browser only need verifying
+    if request.form.get('client_encoded') == '1':
+        with trace.span('verify_client_webp'):
+            valid = file_ext == '.webp' and is_valid_webp(input_path)
+        if not valid:
+            os.remove(input_path)
+            return jsonify({'error': 'Client-encoded upload is not a valid WebP image'}), 400
+        stored = store_result(input_path, Path(filename).stem + '.webp')
+        response = reply_with_result(stored)
+        response.headers['X-File-Size'] = str(stored['size'])
+        response.headers['X-Client-Encoded'] = '1'
+        record_job(filename=filename, kind=kind, engine='client', status='client-encoded',
+                   input_size=stored['size'], output_size=stored['size'], result_id=stored['id'])
+        return response
+    
+    # Pick the encoder engine, either named by the caller or by policy
+    try:
+        engine = select_engine(kind, file_ext,
+                               engine=request.form.get('engine'),
+                               policy=request.form.get('policy', 'balanced'))
+    except ValueError as e:
+        os.remove(input_path)
+        return jsonify({'error': str(e)}), 400
+    
+    extras = [name for name in request.form.get('extras', '').split(',') if name]
+    unknown = [name for name in extras if name not in VIDEO_EXTRAS]
+    if unknown or (extras and kind != 'video'):
+        os.remove(input_path)
+        if unknown:
+            return jsonify({'error': f"Unknown extra output: {', '.join(unknown)}"}), 400
+        return jsonify({'error': 'Poster, thumbnail and sprite outputs are only available for videos'}), 400
+    
+    try:
+        start, duration = trim_range(kind, request.form.get('start'), request.form.get('end'),
+                                     request.form.get('duration'))
+    except ValueError as e:
+        os.remove(input_path)
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        svg_width, svg_dpi = parse_svg_size(request.form.get('svg_width'), request.form.get('svg_dpi'))
+    except ValueError as e:
+        os.remove(input_path)
+        return jsonify({'error': str(e)}), 400
+    
+    target_metric = request.form.get('target_metric', 'ssim')
+    try:
+        target_score = parse_target(target_metric, request.form.get('target_score'))
+    except ValueError as e:
+        os.remove(input_path)
+        return jsonify({'error': str(e)}), 400
+    
+    # Refuse up front what the local ffmpeg build cannot do
+    needed = set().union(*(EXTRA_FILTERS[name] for name in extras))
+    if target_score is not None:
+        needed.add(target_metric)
+    missing = missing_filters(needed)
+    if missing:
+        os.remove(input_path)
+        return jsonify({'error': f"ffmpeg on this server lacks the {', '.join(sorted(missing))} "
+                                 f"filter(s)"}), 400
+    
+    # An explicit speed preset wins over a deadline
+    speed = request.form.get('speed') or None
+    if speed is not None and speed not in SPEED_COST:
+        os.remove(input_path)
+        return jsonify({'error': f'Unknown speed: {speed}'}), 400
+    deadline = request.form.get('deadline') or None
+    if deadline is not None:
+        if not re.fullmatch(r'\d+(\.\d+)?', deadline) or float(deadline) <= 0:
+            os.remove(input_path)
+            return jsonify({'error': 'Deadline must be a positive number of seconds'}), 400
+        deadline = float(deadline)
+    
+    # Identical uploads with identical settings share one encode
+    key = (digest, engine['name'], quality, target_metric, target_score, tuple(sorted(extras)),
+           start, duration, svg_width, svg_dpi, speed, deadline)
+    params = {'quality': quality, 'target_metric': target_metric, 'target_score': target_score,
+              'extras': extras, 'start': start, 'duration': duration,
+              'svg_width': svg_width, 'svg_dpi': svg_dpi, 'speed': speed, 'deadline': deadline}
+    
+    # Charge the client's quota the expected encode time now and settle
+    # with the measured time once this request's own encode has finished
+    client = quota_client() if quotas_enabled() else None
+    estimate = 0
+    if client:
+        estimate = estimate_encode_seconds(input_path, kind, engine, params)
+        charge_quota(client, seconds=estimate)
+    
+    if request.form.get('preview') == '1':
+        return preview_request(trace, input_path, filename, kind, engine, key, params, digest,
+                               client, estimate)
+    
+    started = time.perf_counter()
+    entry, leader = run_conversion(trace, input_path, filename, kind, engine, key, params, digest)
+    error = entry['error']
+    result = entry['result']
+    if client and not BROKER:
+        # A coalesced request rode on another encode and costs nothing.
+        # Behind a broker the wall time includes queueing, so the estimate stands.
+        spent = time.perf_counter() - started if leader else 0
+        charge_quota(client, seconds=spent - estimate)
+    if error is not None:
+        body, status = conversion_error(error)
+        return jsonify(body), status
+    
+    # Send converted file, under its original name without the UUID
+    response = reply_with_result(result['stored'],
+                                 Path(filename).stem + result['stored']['path'].suffix)
+    
+    # Add file size to response headers
+    response.headers['X-File-Size'] = str(result['stored']['size'])
+    response.headers['X-Engine'] = result['engine']
+    response.headers['X-Speed'] = result['speed']
+    if result['retries']:
+        response.headers['X-Retries'] = ','.join(result['retries'])
+    if result['mode']:
+        response.headers['X-WebP-Mode'] = result['mode']
+    response.headers['X-Quality'] = str(result['quality'])
+    if result['score'] is not None:
+        response.headers['X-Quality-Score'] = f"{result['score']:.4f}"
+    if not leader:
+        response.headers['X-Coalesced'] = '1'
+    if result['scaled_to']:
+        response.headers['X-Downscaled'] = '{}x{}'.format(*result['scaled_to'])
+    for name, stored in result['stored_extras'].items():
+        response.headers[f'X-{name.title()}-URL'] = url_for('download_result', result_id=stored['id'])
+    
+    return response
+
+
+# Failures caused by the upload itself rather than by the server
+FAILURE_STATUS = {'corrupt-input': 422, 'unsupported-codec': 415, 'disk-full': 507,
+                  'interrupted': 503}
+
+
+def conversion_error(error):
+    """JSON body and HTTP status to report a failed conversion with"""
+    if isinstance(error, subprocess.TimeoutExpired):
+        body, status = {'error': FAILURE_MESSAGES['timeout'], 'failure': 'timeout'}, 500
+    elif isinstance(error, ImageTooLarge):
+        body, status = {'error': str(error)}, 413
+    else:
+        failure = getattr(error, 'failure', None)
+        body, status = {'error': str(error), 'failure': failure}, FAILURE_STATUS.get(failure, 500)
+    if getattr(error, 'retries', None):
+        body['retries'] = error.retries
+    return body, status
+
+
+def preview_request(trace, input_path, filename, kind, engine, key, params, digest,
+                    client=None, estimate=0):
+    """Answer with a quick low-resolution proxy and finish the full
+    conversion in the background; its state is served at X-Job-URL.
+
+    client and estimate settle the quota like convert_request does, for the
+    preview's encode now and the full conversion's when it finishes.
+    """
+    duration = params['duration']
+    if kind == 'video':
+        duration = min(duration or PREVIEW_SECONDS, PREVIEW_SECONDS)
+    preview_path = input_path.with_name(f'{input_path.stem}.preview{engine["suffix"]}')
+    # Identical previews share one encode too
+    preview_key = (*key, 'preview')
+    entry, leader = join_job(preview_key)
+    started = time.perf_counter()
+    if leader:
+        try:
+            with trace.span('preview'):
+                run = dispatch_media if BROKER else convert_media
+                options = {} if BROKER else {'output_path': preview_path}
+                preview = run(input_path, kind, engine, params['quality'], digest=digest,
+                              trace=trace, start=params['start'], duration=duration,
+                              svg_width=params['svg_width'], svg_dpi=params['svg_dpi'],
+                              speed=SPEEDS[0], max_width=PREVIEW_WIDTH, **options)
+            entry['result'] = store_result(preview['output'],
+                                           f'{Path(filename).stem}.preview{preview["output"].suffix}')
+        except Exception as e:
+            entry['error'] = e
+        finally:
+            finish_job(preview_key, entry)
+        if client and not BROKER:
+            charge_quota(client, seconds=time.perf_counter() - started)
+    else:
+        with trace.span('coalesced_wait'):
+            entry['done'].wait()
+    
+    if entry['error'] is not None:
+        os.remove(input_path)
+        if client and not BROKER:
+            charge_quota(client, seconds=-estimate)
+        body, status = conversion_error(entry['error'])
+        return jsonify(body), status
+    
+    stored = entry['result']
+    job_id = start_background_job(input_path, filename, kind, engine, key, params, digest,
+                                  client, estimate)
+    response = send_result(stored)
+    response.headers['X-Preview'] = '1'
+    response.headers['X-File-Size'] = str(stored['size'])
+    response.headers['X-Engine'] = engine['name']
+    response.headers['X-Job-Id'] = job_id
+    response.headers['X-Job-URL'] = url_for('job_status', job_id=job_id)
+    return response
+
+
+# Full conversions finishing in the background after a preview, kept until
+# RESULT_TTL after they finish
+background_jobs = {}
+background_jobs_lock = threading.Lock()
+
+
+def start_background_job(input_path, filename, kind, engine, key, params, digest,
+                         client=None, estimate=0):
+    job_id = uuid.uuid4().hex
+    job = {'status': 'running', 'entry': None, 'finished': None}
+    now = time.time()
+    with background_jobs_lock:
+        for expired in [old_id for old_id, old in background_jobs.items()
+                        if old['finished'] and now - old['finished'] > RESULT_TTL]:
+            del background_jobs[expired]
+        background_jobs[job_id] = job
+    
+    def run():
+        # Counted as in flight, so a stopping server waits for it
+        with tracked_request():
+            trace = start_trace('background')
+            started = time.perf_counter()
+            entry, leader = run_conversion(trace, input_path, filename, kind, engine, key,
+                                           params, digest)
+            if client and not BROKER:
+                spent = time.perf_counter() - started if leader else 0
+                charge_quota(client, seconds=spent - estimate)
+            job.update(entry=entry, finished=time.time(),
+                       status='failed' if entry['error'] is not None else 'done')
+            trace.finish(job=job_id, status=job['status'])
+    
+    threading.Thread(target=run, daemon=True).start()
+    return job_id
+
+
+def run_conversion(trace, input_path, filename, kind, engine, key, params, digest):
+    """Convert an upload, or wait for an identical conversion already running,
+    and record it in the job history. Removes input_path.
+
+    Returns the coalescing entry (with 'result' or 'error') and whether this
+    call ran the encode.
+    """
+    input_size = input_path.stat().st_size
+    entry, leader = join_job(key)
+    started = time.perf_counter()
+    try:
+        if leader:
+            try:
+                run = dispatch_media if BROKER else convert_media
+                result = run(input_path, kind, engine, params['quality'],
+                             params['target_metric'], params['target_score'], digest=digest,
+                             trace=trace, extras=params['extras'], start=params['start'],
+                             duration=params['duration'], svg_width=params['svg_width'],
+                             svg_dpi=params['svg_dpi'], speed=params['speed'],
+                             deadline=params['deadline'])
+                download_name = Path(filename).stem + result['output'].suffix
+                result['stored'] = store_result(result['output'], download_name)
+                result['stored_extras'] = {
+                    name: store_result(path, f'{Path(filename).stem}.{name}.webp')
+                    for name, path in result['extras'].items()
+                }
+                entry['result'] = result
+            except Exception as e:
+                entry['error'] = e
+            finally:
+                finish_job(key, entry)
+        else:
+            with trace.span('coalesced_wait'):
+                entry['done'].wait()
+    finally:
+        os.remove(input_path)
+    
+    error = entry['error']
+    result = entry['result']
+    if leader and error is None:
+        # Behind a broker, the worker's own time leaves out queueing
+        note_job_seconds(result.get('encode_seconds') or time.perf_counter() - started)
+    record_job(
+        filename=filename,
+        kind=kind,
+        engine=result['engine'] if result else engine['name'],
+        status=('failed' if error is not None else 'converted') if leader else 'coalesced',
+        input_size=input_size,
+        output_size=result['stored']['size'] if result else None,
+        quality=result['quality'] if result else params['quality'],
+        quality_score=result['score'] if result else None,
+        encode_seconds=round(time.perf_counter() - started, 3) if leader else None,
+        media_seconds=result['media_seconds'] if result else None,
+        params=params,
+        error=str(error) if error is not None else None,
+        result_id=result['stored']['id'] if result else None,
+        failure=conversion_error(error)[0].get('failure') if error is not None else None,
+        failure_detail=getattr(error, 'detail', None),
+        retries=(result['retries'] if result else getattr(error, 'retries', None)) or None,
+    )
+    return entry, leader
+
+@app.route('/results/<result_id>')
+def download_result(result_id):
+    result = get_result(result_id)
+    if result is None:
+        return jsonify({'error': 'Result not found or expired'}), 404
+    return send_result(result)
+
+
+@app.route('/results/archive', methods=['POST'])
+def download_archive():
+    """Stream the stored results named in ids (comma-separated) as one zip"""
+    stored = [result for result in map(get_result, request.form.get('ids', '').split(','))
+              if result is not None]
+    if not stored:
+        return jsonify({'error': 'No results found; they may have expired'}), 404
+    
+    # Keep the files around for the length of the transfer, and give
+    # duplicate names a numbered suffix
+    entries = []
+    names = set()
+    with results_lock:
+        for result in stored:
+            result['expires'] = max(result['expires'], time.time() + RESULT_TTL)
+            name = result['download_name']
+            stem, suffix = Path(name).stem, Path(name).suffix
+            number = 1
+            while name in names:
+                number += 1
+                name = f'{stem} ({number}){suffix}'
+            names.add(name)
+            entries.append((name, result['path']))
+    
+    response = app.response_class(stream_zip(entries), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=request.form.get('name', 'converted') + '.zip')
+    return response
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = background_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    body = {'status': job['status']}
+    if job['status'] == 'failed':
+        body.update(conversion_error(job['entry']['error'])[0])
+    elif job['status'] == 'done':
+        result = job['entry']['result']
+        body.update(
+            id=result['stored']['id'],
+            url=url_for('download_result', result_id=result['stored']['id']),
+            download_name=result['stored']['download_name'],
+            size=result['stored']['size'],
+            quality=result['quality'],
+            speed=result['speed'],
+            engine=result['engine'],
+            retries=result['retries'],
+            extras={name: url_for('download_result', result_id=stored['id'])
+                    for name, stored in result['stored_extras'].items()},
+        )
+    return jsonify(body)
+
+
+@app.route('/health')
+def health():
+    report = capability_report()
+    report['active_jobs'] = active_requests
+    report['draining'] = draining.is_set()
+    report['process'] = process_stats()
+    healthy = all(report['kinds'].values()) and not report['draining']
+    report['status'] = 'ok' if healthy else 'draining' if report['draining'] else 'degraded'
+    return jsonify(report), 200 if healthy else 503
+
+
+def process_stats():
+    """Memory, file descriptors, child processes and temporary files of this
+    server, to spot leaks under sustained load. The /proc figures are only
+    reported on Linux."""
+    stats = {'pid': os.getpid(), 'threads': threading.active_count(),
+             'ffmpeg_processes': len(active_processes), 'stored_results': len(results)}
+    try:
+        with open('/proc/self/statm') as f:
+            stats['rss_mb'] = round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576, 1)
+        stats['open_fds'] = len(os.listdir('/proc/self/fd'))
+        stats['children'] = 0
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    # The command name is in parentheses and may contain spaces
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == stats['pid']:
+                        stats['children'] += 1
+            except (OSError, IndexError, ValueError):
+                pass  # Exited while we looked
+    except OSError:
+        pass
+    
+    temp_bytes = temp_files = 0
+    for root, dirs, names in os.walk(UPLOAD_FOLDER):
+        for name in names:
+            try:
+                temp_bytes += os.stat(os.path.join(root, name)).st_size
+                temp_files += 1
+            except OSError:
+                pass
+    stats['temp_files'] = temp_files
+    stats['temp_mb'] = round(temp_bytes / 1048576, 1)
+    return stats
+
+
+@app.route('/history')
+def history():
+    db = history_db()
+    if db is None:
+        return jsonify({'error': 'Job history is disabled'}), 404
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(500, max(1, request.args.get('per_page', 50, type=int)))
+    
+    # Optional exact-match filters
+    filters = {column: request.args[column] for column in ('kind', 'engine', 'status', 'failure')
+               if request.args.get(column)}
+    where = ' AND '.join(f'{column} = ?' for column in filters) or '1'
+    values = list(filters.values())
+    
+    total = db.execute(f'SELECT COUNT(*) FROM jobs WHERE {where}', values).fetchone()[0]
+    rows = db.execute(f'SELECT * FROM jobs WHERE {where} ORDER BY id DESC LIMIT ? OFFSET ?',
+                      values + [per_page, (page - 1) * per_page]).fetchall()
+    jobs = []
+    for row in rows:
+        job = dict(row)
+        job['params'] = json.loads(job['params']) if job['params'] else None
+        job['retries'] = json.loads(job['retries']) if job['retries'] else None
+        jobs.append(job)
+    return jsonify({'jobs': jobs, 'page': page, 'per_page': per_page, 'total': total})
+
+@app.route('/stats')
+def stats():
+    db = history_db()
+    if db is None:
+        return jsonify({'error': 'Job history is disabled'}), 404
+    since = request.args.get('since', 0, type=float)
+    
+    totals = db.execute("""
+        SELECT COUNT(*) AS jobs,
+               SUM(status = 'converted') AS converted,
+               SUM(status = 'failed') AS failed,
+               SUM(status = 'coalesced') AS coalesced,
+               SUM(status = 'client-encoded') AS client_encoded,
+               SUM(input_size) AS input_bytes,
+               SUM(output_size) AS output_bytes,
+               SUM(input_size - output_size) AS bytes_saved
+        FROM jobs WHERE created >= ?
+    """, (since,)).fetchone()
+    
+    # Encode speed by engine, from jobs that actually ran an encoder
+    engines = db.execute("""
+        SELECT engine,
+               COUNT(*) AS jobs,
+               AVG(encode_seconds) AS avg_encode_seconds,
+               SUM(input_size) / SUM(encode_seconds) / 1048576.0 AS avg_input_mb_per_second,
+               SUM(media_seconds) / SUM(encode_seconds) AS realtime_factor,
+               AVG(100.0 * (input_size - output_size) / input_size) AS avg_reduction_percent,
+               AVG(quality) AS avg_quality
+        FROM jobs
+        WHERE status = 'converted' AND created >= ? AND encode_seconds > 0
+        GROUP BY engine ORDER BY jobs DESC
+    """, (since,)).fetchall()
+    
+    # Failed jobs by failure class, and how often a retry rescued a job
+    failures = db.execute("""
+        SELECT COALESCE(failure, 'unknown') AS failure, COUNT(*) AS jobs
+        FROM jobs WHERE status = 'failed' AND created >= ?
+        GROUP BY failure ORDER BY jobs DESC
+    """, (since,)).fetchall()
+    recovered = db.execute("""
+        SELECT COUNT(*) FROM jobs
+        WHERE status = 'converted' AND retries IS NOT NULL AND created >= ?
+    """, (since,)).fetchone()[0]
+    return jsonify({'totals': dict(totals), 'engines': [dict(row) for row in engines],
+                    'failures': {row['failure']: row['jobs'] for row in failures},
+                    'recovered_by_retry': recovered})
+
+
+def init_batch_worker(counter, workers):
+    """Give each pool process its own slice of cores so their encodes don't overlap"""
+    global core_allocator
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    cores = sorted(core_allocator.cores)
+    per_worker = max(1, len(cores) // workers)
+    start = (index * per_worker) % len(cores)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores[start:start + per_worker])
+    core_allocator = CoreAllocator()
+
+
+def batch_convert_one(source, target, previous, options, skip):
+    """Convert one file of a batch; returns its manifest entry"""
+    entry = {'input_size': source.stat().st_size, 'options': options}
+    if skip == 'hash' or previous.get('sha256'):
+        entry['sha256'] = file_digest(source)
+    # Outputs made with different settings are never up to date
+    if target.exists() and previous.get('options', options) == options:
+        if skip == 'mtime' and target.stat().st_mtime >= source.stat().st_mtime:
+            return dict(previous, **entry, status='skipped')
+        if skip == 'hash' and previous.get('sha256') == entry['sha256']:
+            return dict(previous, **entry, status='skipped')
+    
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        result = convert_file(source, target, **batch_options(source, options))
+    except subprocess.TimeoutExpired:
+        return dict(entry, status='error', error='Conversion timeout', failure='timeout')
+    except Exception as e:
+        return dict(entry, status='error', error=str(e), failure=getattr(e, 'failure', None))
+    result['output'] = str(target)
+    return dict(entry, **result, status='converted')
+
+
+def batch_options(source, options):
+    """Conversion options for one file of a batch. A named engine only
+    applies to files of its kind; the others get the policy's engine.
+    Posters, sprites and trimming only apply to videos."""
+    kind = media_kind(source.suffix.lower())
+    options = dict(options)
+    if options.get('engine') in ENGINES and ENGINES[options['engine']]['kind'] != kind:
+        options['engine'] = None
+    if kind != 'video':
+        options.update(extras=(), start=None, end=None, duration=None)
+    return options
+
+
+def batch_target(source, source_dir, output_dir, options):
+    """Output path mirroring source under output_dir, or None if it isn't convertible"""
+    file_ext = source.suffix.lower()
+    kind = media_kind(file_ext)
+    if kind is None:
+        return None
+    try:
+        engine = select_engine(kind, file_ext, engine=batch_options(source, options)['engine'],
+                               policy=options.get('policy', 'balanced'))
+    except ValueError:
+        # convert_file() raises the same error, which is recorded for this file
+        engine = select_engine(kind, file_ext, policy=options.get('policy', 'balanced'))
+    return (output_dir / source.relative_to(source_dir)).with_suffix(engine['suffix'])
+
+
+def check_folders(source_dir, output_dir):
+    """Refuse an output folder that is, or is inside, the source folder:
+    outputs would replace their sources or be picked up as new inputs"""
+    source, output = Path(source_dir).resolve(), Path(output_dir).resolve()
+    if output == source or source in output.parents:
+        raise ValueError(f'Output folder {output_dir} must not be inside {source_dir}')
+
+
+def write_manifest(path, manifest):
+    tmp_path = Path(str(path) + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def convert_directory(source_dir, output_dir, workers=None, skip='mtime', manifest_path=None,
+                      **options):
+    """Convert every supported file under source_dir into output_dir, in parallel.
+
+    The directory layout is mirrored and files whose outputs are up to date
+    (by mtime, or by content hash recorded in a previous manifest) are
+    skipped. A JSON manifest with per-file sizes and timings is written to
+    manifest_path (default: output_dir/manifest.json) and returned.
+    """
+    source_dir, output_dir = Path(source_dir), Path(output_dir)
+    check_folders(source_dir, output_dir)
+    manifest_path = Path(manifest_path) if manifest_path else output_dir / 'manifest.json'
+    workers = workers or os.cpu_count() or 1
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    previous = {}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            previous = json.load(f).get('files', {})
+    
+    jobs = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs.sort()
+        for name in sorted(files):
+            source = Path(root) / name
+            target = batch_target(source, source_dir, output_dir, options)
+            if target is not None:
+                jobs.append((str(source.relative_to(source_dir)), source, target))
+    
+    manifest = {'source': str(source_dir), 'output': str(output_dir), 'started': time.time(),
+                'files': {}}
+    counter = multiprocessing.Value('i', 0)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker,
+                             initargs=(counter, workers)) as pool:
+        futures = {
+            pool.submit(batch_convert_one, source, target, previous.get(rel, {}), options, skip): rel
+            for rel, source, target in jobs
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            rel = futures[future]
+            manifest['files'][rel] = future.result()
+            print(f"[{done}/{len(jobs)}] {manifest['files'][rel]['status']}: {rel}")
+            if done % 100 == 0:
+                write_manifest(manifest_path, manifest)
+    
+    manifest['finished'] = time.time()
+    statuses = [entry['status'] for entry in manifest['files'].values()]
+    manifest['summary'] = {status: statuses.count(status) for status in set(statuses)}
+    write_manifest(manifest_path, manifest)
+    return manifest
+
+
+class Inotify:
+    """Minimal inotify binding (Linux only) reporting changed paths under watched trees"""
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def add_tree(self, directory):
+        for root, dirs, files in os.walk(directory):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), self.MASK)
+            if wd >= 0:
+                self.watches[wd] = Path(root)
+
+    def wait(self, timeout):
+        """Paths touched within timeout seconds, or None if the queue overflowed"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = b''
+        while True:
+            try:
+                data += os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if wd not in self.watches or not name:
+                continue
+            path = self.watches[wd] / os.fsdecode(name)
+            if mask & self.IN_ISDIR:
+                # New subdirectory: watch it and report whatever is already in it
+                self.add_tree(path)
+                paths.extend(Path(root) / name for root, dirs, files in os.walk(path)
+                             for name in files)
+            else:
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+def scan_tree(directory):
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            yield Path(root) / name
+
+
+def watch_directory(source_dir, output_dir, workers=None, settle=2.0, poll_interval=5.0,
+                    state_path=None, use_inotify=True, **options):
+    """Convert files dropped into source_dir until interrupted.
+
+    Changes are picked up through inotify where available, otherwise by
+    rescanning every poll_interval seconds. A file is queued once its size
+    and mtime have stayed unchanged for settle seconds, so files still being
+    copied in are left alone. Results are kept in a JSON state index
+    (default: output_dir/.watch-state.json) so a restart only converts files
+    that are new or changed since they were last processed.
+    """
+    source_dir, output_dir = Path(source_dir), Path(output_dir)
+    check_folders(source_dir, output_dir)
+    state_path = Path(state_path) if state_path else output_dir / '.watch-state.json'
+    workers = workers or os.cpu_count() or 1
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    state = {'files': {}}
+    if state_path.exists():
+        with open(state_path) as f:
+            state = json.load(f)
+    
+    watcher = None
+    if use_inotify and sys.platform.startswith('linux'):
+        try:
+            watcher = Inotify()
+            watcher.add_tree(source_dir)
+        except OSError:
+            watcher = None
+    print(f"Watching {source_dir} ({'inotify' if watcher else 'polling'})")
+    
+    pending = {}   # path -> (size, mtime, time first seen with that size and mtime)
+    running = {}   # future -> (rel, size, mtime)
+    changed = list(scan_tree(source_dir))
+    counter = multiprocessing.Value('i', 0)
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker,
+                               initargs=(counter, workers))
+    try:
+        while True:
+            for path in changed:
+                if media_kind(path.suffix.lower()) is None:
+                    continue
+                try:
+                    stat = path.stat()
+                except OSError:
+                    pending.pop(path, None)
+                    continue
+                done = state['files'].get(str(path.relative_to(source_dir)))
+                if done and done['size'] == stat.st_size and done['mtime'] == stat.st_mtime:
+                    continue
+                if path not in pending or pending[path][:2] != (stat.st_size, stat.st_mtime):
+                    pending[path] = (stat.st_size, stat.st_mtime, time.time())
+            
+            # Queue files that have stopped changing
+            busy = {rel for rel, size, mtime in running.values()}
+            for path, (size, mtime, since) in list(pending.items()):
+                rel = str(path.relative_to(source_dir))
+                if time.time() - since < settle or rel in busy:
+                    continue
+                try:
+                    stat = path.stat()
+                except OSError:
+                    del pending[path]
+                    continue
+                if (stat.st_size, stat.st_mtime) != (size, mtime):
+                    pending[path] = (stat.st_size, stat.st_mtime, time.time())
+                    continue
+                del pending[path]
+                target = batch_target(path, source_dir, output_dir, options)
+                future = pool.submit(batch_convert_one, path, target, {}, options, 'none')
+                running[future] = (rel, size, mtime)
+            
+            # Record finished conversions
+            for future in [future for future in running if future.done()]:
+                rel, size, mtime = running.pop(future)
+                entry = future.result()
+                entry.update(size=size, mtime=mtime, processed=time.time())
+                state['files'][rel] = entry
+                write_manifest(state_path, state)
+                print(f"{entry['status']}: {rel}")
+            
+            timeout = min(settle / 2, poll_interval) if pending or running else poll_interval
+            if watcher:
+                changed = watcher.wait(timeout)
+                if changed is None:
+                    changed = list(scan_tree(source_dir))
+                else:
+                    changed += list(pending)
+            else:
+                time.sleep(timeout)
+                changed = list(scan_tree(source_dir))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Drop queued conversions and let the running ones finish
+        for future in running:
+            future.cancel()
+        pool.shutdown(wait=True)
+        for future, (rel, size, mtime) in running.items():
+            if future.done() and not future.cancelled():
+                state['files'][rel] = dict(future.result(), size=size, mtime=mtime,
+                                           processed=time.time())
+        write_manifest(state_path, state)
+        if watcher:
+            watcher.close()
+
+
+def work_job(broker, worker_name, job_id, job, input_path, stop):
+    """Run one claimed broker job and report its outputs or error back"""
+    result = {'worker': worker_name}
+    files = {}
+    try:
+        if job['engine'] not in ENGINES or not engine_available(job['engine']):
+            raise ConversionError(f"Engine {job['engine']} is not available on {worker_name}")
+        engine = ENGINES[job['engine']]
+        started = time.perf_counter()
+        converted = convert_media(input_path, job['kind'], engine, job['quality'],
+                                  job['target_metric'], job['target_score'], digest=job['digest'],
+                                  timeout=job['timeout'], extras=job['extras'],
+                                  start=job['start'], duration=job['duration'],
+                                  svg_width=job['svg_width'], svg_dpi=job['svg_dpi'],
+                                  speed=job['speed'], deadline=job['deadline'],
+                                  max_width=job.get('max_width'))
+        files = {'output': converted['output'], **converted['extras']}
+        result.update(quality=converted['quality'], score=converted['score'],
+                      speed=converted['speed'], mode=converted['mode'],
+                      engine=converted['engine'], retries=converted['retries'],
+                      scaled_to=converted['scaled_to'], media_seconds=converted['media_seconds'],
+                      seconds=time.perf_counter() - started, files=list(files))
+    except Exception as e:
+        if stop.is_set():
+            # Killed by shutdown: hand the job to another worker
+            broker.release(job_id)
+            return
+        result.update(error=str(e), error_type=type(e).__name__,
+                      failure=getattr(e, 'failure', None), detail=getattr(e, 'detail', None),
+                      retries=getattr(e, 'retries', []))
+    broker.finish(job_id, result, files)
+
+
+def run_worker(spec, concurrency=1, name=None, grace=SHUTDOWN_GRACE):
+    """Pull jobs from the broker at spec until interrupted.
+
+    On shutdown running jobs get grace seconds to finish; the ones that do
+    not are killed and put back on the queue.
+    """
+    broker = open_broker(spec)
+    name = name or f'{socket.gethostname()}:{os.getpid()}'
+    stop = threading.Event()
+    held = set()
+    
+    def loop():
+        workdir = Path(tempfile.mkdtemp(dir=UPLOAD_FOLDER))
+        while not stop.is_set():
+            job_id = None
+            try:
+                # Losing a race with another worker must not end this slot
+                claimed = broker.claim(name, workdir)
+                if claimed is None:
+                    stop.wait(BROKER_POLL)
+                    continue
+                job_id, job, input_path = claimed
+                held.add(job_id)
+                work_job(broker, name, job_id, job, input_path, stop)
+            except Exception as e:
+                print(f"{job_id or 'claim'}: {e}")
+                stop.wait(BROKER_POLL)
+            finally:
+                held.discard(job_id)
+                for path in workdir.iterdir():
+                    if path.is_file():
+                        path.unlink()
+    
+    def beat(until):
+        # Heartbeats keep the leases of held jobs from running out, and tell
+        # front ends how many slots are attached (none once stopping)
+        while any(thread.is_alive() for thread in threads) and time.monotonic() < until:
+            try:
+                broker.announce(name, 0 if stop.is_set() else concurrency)
+            except Exception as e:
+                print(f"announce failed: {e}")
+            for job_id in list(held):
+                try:
+                    broker.heartbeat(job_id)
+                except Exception as e:
+                    print(f"{job_id}: heartbeat failed: {e}")
+            time.sleep(max(0, min(5, BROKER_LEASE / 3, until - time.monotonic())))
+    
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    print(f"Worker {name} pulling from {spec} with {concurrency} slot(s)")
+    try:
+        beat(math.inf)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    
+    stop.set()
+    draining.set()
+    try:
+        if held:
+            print(f"Waiting up to {grace:g}s for {len(held)} job(s) to finish")
+        beat(time.monotonic() + grace)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    kill_active_processes()
+    for thread in threads:
+        thread.join(10)
+    shutil.rmtree(UPLOAD_FOLDER, ignore_errors=True)
+
+
+# Soak test defaults: the limits a run fails on. Leaked descriptors and
+# processes are counted between idle samples before and after the run; RSS
+# growth from the end of the warm-up, once caches have filled, to the end.
+SOAK_THRESHOLDS = {
+    'max_error_rate': 0.01,
+    'max_p99_seconds': 120.0,
+    'min_jobs_per_minute': 0.0,
+    'max_rss_growth_mb': 256.0,
+    'max_fd_growth': 32,
+    'max_leaked_processes': 0,
+    'max_temp_mb': 2048.0,
+}
+
+
+def soak_fixtures(folder, count):
+    """Generate count images and count short videos with ffmpeg's test
+    source. Each gets its own noise seed, so uploads neither coalesce nor
+    hit cached results."""
+    fixtures = {'image': [], 'video': []}
+    for i in range(count):
+        width, height = random.choice([(640, 360), (1280, 720), (1920, 1080)])
+        source = f'testsrc2=size={width}x{height}:rate=25,noise=alls=12:allf=t:all_seed={i + 1}'
+        image = folder / f'image{i}.png'
+        subprocess.run(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', source,
+                        '-frames:v', '1', str(image)], check=True, timeout=120)
+        fixtures['image'].append(image)
+        video = folder / f'video{i}.mp4'
+        subprocess.run(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', source,
+                        '-f', 'lavfi', '-i', f'sine=frequency={220 + 20 * i}',
+                        '-t', str(random.randint(2, 8)), '-c:v', 'mpeg4', '-q:v', '4',
+                        '-c:a', 'aac', str(video)], check=True, timeout=300)
+        fixtures['video'].append(video)
+    return fixtures
+
+
+def soak_request(url, path, fields, timeout):
+    """POST one file to url's /convert and read the whole reply.
+
+    Returns the HTTP status (None when the request itself failed), its
+    Retry-After, the seconds taken and an error message for failures.
+    """
+    boundary = uuid.uuid4().hex
+    body = b''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in fields.items())
+    body += (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+             f'filename="{path.name}"\r\nContent-Type: application/octet-stream\r\n\r\n').encode()
+    body += path.read_bytes() + f'\r\n--{boundary}--\r\n'.encode()
+    req = urllib.request.Request(url + '/convert', data=body, headers={
+        'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    started = time.monotonic()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            for chunk in iter(lambda: response.read(1024 * 1024), b''):
+                pass
+            return response.status, None, time.monotonic() - started, None
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read() or b'{}').get('error')
+        except ValueError:
+            message = None
+        return e.code, e.headers.get('Retry-After'), time.monotonic() - started, message
+    except Exception as e:
+        return None, None, time.monotonic() - started, str(e) or type(e).__name__
+
+
+def soak_health(url):
+    """The server's /health report; it answers 503 while degraded"""
+    try:
+        with urllib.request.urlopen(url + '/health', timeout=30) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read() or b'{}')
+    except (OSError, ValueError):
+        return {}
+
+
+def soak_worker(url, fixtures, video_share, deadline, tally, lock, timeout):
+    while time.monotonic() < deadline:
+        kind = 'video' if fixtures['video'] and random.random() < video_share else 'image'
+        fields = {'quality': random.randint(20, 60)}
+        status, retry_after, seconds, error = soak_request(url, random.choice(fixtures[kind]),
+                                                           fields, timeout)
+        with lock:
+            if status == 200:
+                tally['latencies'][kind].append(seconds)
+            elif status in (429, 503):
+                tally['throttled'] += 1
+            else:
+                tally['errors'][f'{status or "request"}: {error}'] += 1
+        if status in (429, 503):
+            # Back off like a well-behaved client would
+            wait = float(retry_after) if retry_after and retry_after.isdigit() else 1.0
+            time.sleep(max(0, min(wait, deadline - time.monotonic())))
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_soak(url, duration, concurrency=4, video_share=0.3, fixtures=None, fixture_count=4,
+             warmup=None, sample_interval=10, timeout=600, thresholds=None):
+    """Drive url's /convert with concurrent image and video jobs for
+    duration seconds while sampling its /health process stats.
+
+    fixtures is a folder of inputs to use instead of generated ones. Returns
+    a summary with throughput, latency, errors and resource drift, and the
+    thresholds (SOAK_THRESHOLDS, overridden by thresholds) it broke.
+    """
+    limits = dict(SOAK_THRESHOLDS, **(thresholds or {}))
+    url = url.rstrip('/')
+    warmup = min(60, duration / 10) if warmup is None else warmup
+    
+    fixture_folder = None
+    if fixtures:
+        inputs = {'image': [], 'video': []}
+        for path in sorted(Path(fixtures).iterdir()):
+            kind = media_kind(path.suffix.lower())
+            if kind:
+                inputs[kind].append(path)
+    else:
+        fixture_folder = Path(tempfile.mkdtemp(prefix='soak-'))
+        print(f"Generating {fixture_count} image and video fixtures...")
+        inputs = soak_fixtures(fixture_folder, fixture_count)
+    if not inputs['image'] and not inputs['video']:
+        raise ValueError('No convertible fixtures')
+    if not inputs['image']:
+        video_share = 1.0
+    
+    initial = soak_health(url).get('process', {})
+    tally = {'latencies': {'image': [], 'video': []}, 'throttled': 0, 'errors': Counter()}
+    lock = threading.Lock()
+    started = time.monotonic()
+    deadline = started + duration
+    threads = [threading.Thread(target=soak_worker, daemon=True,
+                                args=(url, inputs, video_share, deadline, tally, lock, timeout))
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    
+    baseline = None
+    peak_temp_mb = 0
+    try:
+        while time.monotonic() < deadline:
+            time.sleep(max(0, min(sample_interval, deadline - time.monotonic())))
+            process = soak_health(url).get('process', {})
+            peak_temp_mb = max(peak_temp_mb, process.get('temp_mb', 0))
+            if baseline is None and time.monotonic() - started >= warmup:
+                baseline = process
+            with lock:
+                done = sum(len(values) for values in tally['latencies'].values())
+                errors = sum(tally['errors'].values())
+                latencies = tally['latencies']['image'] + tally['latencies']['video']
+            p99 = percentile(latencies, 0.99)
+            print(f"{time.monotonic() - started:7.0f}s  {done} done, {errors} errors, "
+                  f"{tally['throttled']} throttled, p99 {p99 or 0:.1f}s, "
+                  f"rss {process.get('rss_mb', '?')}MB, fds {process.get('open_fds', '?')}, "
+                  f"children {process.get('children', '?')}, temp {process.get('temp_mb', '?')}MB")
+    finally:
+        for thread in threads:
+            thread.join(timeout)
+        if fixture_folder:
+            shutil.rmtree(fixture_folder, ignore_errors=True)
+    elapsed = time.monotonic() - started
+    
+    # Leaks show once the server has nothing left to do
+    idle_deadline = time.monotonic() + 60
+    while True:
+        health = soak_health(url)
+        final = health.get('process', {})
+        if not health.get('active_jobs') and not final.get('ffmpeg_processes'):
+            break
+        if time.monotonic() > idle_deadline:
+            break
+        time.sleep(1)
+    baseline = baseline or final
+    
+    latencies = tally['latencies']['image'] + tally['latencies']['video']
+    errors = sum(tally['errors'].values())
+    attempts = len(latencies) + errors
+    summary = {
+        'seconds': round(elapsed, 1),
+        'jobs': len(latencies),
+        'jobs_per_minute': round(len(latencies) * 60 / elapsed, 2),
+        'errors': errors,
+        'error_rate': round(errors / attempts, 4) if attempts else 0.0,
+        'error_kinds': dict(tally['errors'].most_common(10)),
+        'throttled': tally['throttled'],
+        'latency': {kind: {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95),
+                           'p99': percentile(values, 0.99), 'max': max(values, default=None)}
+                    for kind, values in tally['latencies'].items()},
+        'initial': initial,
+        'baseline': baseline,
+        'final': final,
+        'peak_temp_mb': peak_temp_mb,
+    }
+    
+    checks = [
+        ('max_error_rate', summary['error_rate'], lambda value, limit: value <= limit),
+        ('max_p99_seconds', percentile(latencies, 0.99) or 0, lambda value, limit: value <= limit),
+        ('min_jobs_per_minute', summary['jobs_per_minute'], lambda value, limit: value >= limit),
+        ('max_temp_mb', peak_temp_mb, lambda value, limit: value <= limit),
+    ]
+    # The process figures come from /proc, so only Linux servers report them
+    if 'rss_mb' in final and 'rss_mb' in initial:
+        checks += [
+            ('max_rss_growth_mb', final['rss_mb'] - baseline['rss_mb'],
+             lambda value, limit: value <= limit),
+            ('max_fd_growth', final['open_fds'] - initial['open_fds'],
+             lambda value, limit: value <= limit),
+            ('max_leaked_processes', final['children'] - initial['children'],
+             lambda value, limit: value <= limit),
+        ]
+    summary['failed'] = {name: {'value': value, 'limit': limits[name]}
+                         for name, value, passes in checks if not passes(value, limits[name])}
+    return summary
+
+
+def report_capabilities():
+    """Probe ffmpeg up front and warn about engines that cannot run"""
+    report = capability_report()
+    if not report['ffmpeg']['version']:
+        print("Warning: could not run ffmpeg; conversions will fail")
+        return report
+    print(f"ffmpeg {report['ffmpeg']['version']}, {report['usable_threads']} of "
+          f"{report['threads']} threads usable")
+    unavailable = sorted(name for name, available in report['engines'].items() if not available)
+    if unavailable:
+        print(f"Engines not available with this build: {', '.join(unavailable)}")
+    for kind, available in report['kinds'].items():
+        if not available:
+            print(f"Warning: no {kind} engine is available")
+    return report
+
+
+def serve(args):
+    print("Web Media Converter with Beautiful Themes")
+    print(f"Running at: http://{args.host}:{args.port}")
+    print("Convert multiple media files locally with style!")
+    print("Multiple file support enabled!")
+    report_capabilities()
+    if args.reload:
+        # The reloader's parent kills the serving process on SIGTERM, so
+        # nothing gets drained in this mode
+        app.run(host=args.host, debug=True, port=args.port, threaded=True, use_reloader=True)
+        return 0
+    
+    app.debug = True
+    server = make_server(args.host, args.port, DebuggedApplication(app, evalex=True),
+                         threaded=True)
+    
+    def stop(signum, frame):
+        # The server keeps answering while running conversions finish; new
+        # ones get a 503. A second signal skips the wait.
+        if draining.is_set():
+            skip_drain()
+            return
+        print("Shutting down...")
+        threading.Thread(target=lambda: (drain_jobs(), server.shutdown()), daemon=True).start()
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.serve_forever()
+    return 0
+
+
+def conversion_options(args):
+    return {
+        'quality': args.quality,
+        'engine': args.engine,
+        'policy': args.policy,
+        'target_metric': args.target_metric,
+        'target_score': args.target_score,
+        'timeout': args.timeout,
+        'extras': args.extras,
+        'start': args.start,
+        'end': args.end,
+        'duration': args.duration,
+        'svg_width': args.svg_width,
+        'svg_dpi': args.svg_dpi,
+        'speed': args.speed,
+        'deadline': args.deadline,
+    }
+
+
+def batch(args):
+    try:
+        manifest = convert_directory(args.source, args.output, workers=args.workers,
+                                     skip=args.skip, manifest_path=args.manifest,
+                                     **conversion_options(args))
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 2
+    print(json.dumps(manifest['summary']))
+    return 1 if manifest['summary'].get('error') else 0
+
+
+def watch(args):
+    try:
+        watch_directory(args.source, args.output, workers=args.workers, settle=args.settle,
+                        poll_interval=args.poll_interval, state_path=args.state,
+                        use_inotify=not args.poll, **conversion_options(args))
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 2
+    return 0
+
+
+def worker(args):
+    report_capabilities()
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    run_worker(args.broker, concurrency=args.concurrency, name=args.name)
+    return 0
+
+
+def probe(args):
+    report = capability_report()
+    print(json.dumps(report, indent=2))
+    # Engines are assumed usable when ffmpeg could not be probed; still fail
+    return 0 if report['ffmpeg']['version'] and all(report['kinds'].values()) else 1
+
+
+def soak(args):
+    thresholds = {name: getattr(args, name) for name in SOAK_THRESHOLDS
+                  if getattr(args, name) is not None}
+    summary = run_soak(args.url, args.duration, concurrency=args.concurrency,
+                       video_share=args.video_share, fixtures=args.fixtures,
+                       fixture_count=args.fixture_count, warmup=args.warmup,
+                       sample_interval=args.sample_interval, timeout=args.timeout,
+                       thresholds=thresholds)
+    print(json.dumps(summary, indent=2))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(summary, f, indent=2)
+    for name, breach in summary['failed'].items():
+        print(f"FAILED {name}: {breach['value']} (limit {breach['limit']})")
+    return 1 if summary['failed'] else 0
+
+
+def add_conversion_arguments(parser):
+    parser.add_argument('--quality', type=int, default=30, help='quality reduction, 10-90')
+    parser.add_argument('--engine', choices=sorted(ENGINES), help='encoder engine')
+    parser.add_argument('--policy', choices=sorted(ENGINE_POLICIES), default='balanced')
+    parser.add_argument('--target-metric', choices=sorted(TARGET_SCORE_RANGES), default='ssim')
+    parser.add_argument('--target-score', type=float,
+                        help='search for the smallest output reaching this score')
+    parser.add_argument('--timeout', type=int, default=300, help='per-file encode timeout')
+    parser.add_argument('--extras', type=lambda value: [name for name in value.split(',') if name],
+                        default=[], help=f"extra video outputs: {','.join(VIDEO_EXTRAS)}")
+    parser.add_argument('--start', help='trim videos from this time (seconds or [HH:]MM:SS)')
+    parser.add_argument('--end', help='trim videos up to this time')
+    parser.add_argument('--duration', help='trim videos to this length')
+    parser.add_argument('--svg-width', type=int, help=f'SVG raster width (default {SVG_DEFAULT_WIDTH})')
+    parser.add_argument('--svg-dpi', type=int, help=f'SVG raster DPI (default {SVG_DEFAULT_DPI})')
+    parser.add_argument('--speed', choices=SPEEDS,
+                        help=f'encoder speed preset (default {DEFAULT_SPEED})')
+    parser.add_argument('--deadline', type=float,
+                        help='pick the slowest speed expected to finish within these seconds')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert videos to WebM and images to WebP')
+    commands = parser.add_subparsers(dest='command')
+    
+    serve_parser = commands.add_parser('serve', help='run the web UI (default)')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--reload', action='store_true',
+                              help='restart on code changes (SIGTERM then skips draining)')
+    serve_parser.set_defaults(func=serve)
+    
+    probe_parser = commands.add_parser('probe', help='report what the local ffmpeg supports')
+    probe_parser.set_defaults(func=probe)
+    
+    worker_parser = commands.add_parser('worker', help='run conversions queued in a broker')
+    worker_parser.add_argument('broker', help='shared queue directory, or SQLite .db path')
+    worker_parser.add_argument('--concurrency', type=int, default=1, help='jobs run at once')
+    worker_parser.add_argument('--name', help='worker name reported with results')
+    worker_parser.set_defaults(func=worker)
+    
+    batch_parser = commands.add_parser('batch', help='convert a directory tree')
+    batch_parser.add_argument('source')
+    batch_parser.add_argument('output')
+    batch_parser.add_argument('--workers', type=int, help='worker processes (default: CPU count)')
+    batch_parser.add_argument('--skip', choices=['mtime', 'hash', 'none'], default='mtime',
+                              help='how to detect outputs that are already up to date')
+    batch_parser.add_argument('--manifest', help='manifest path (default: OUTPUT/manifest.json)')
+    add_conversion_arguments(batch_parser)
+    batch_parser.set_defaults(func=batch)
+    
+    watch_parser = commands.add_parser('watch', help='convert files as they appear in a folder')
+    watch_parser.add_argument('source')
+    watch_parser.add_argument('output')
+    watch_parser.add_argument('--workers', type=int, help='worker processes (default: CPU count)')
+    watch_parser.add_argument('--settle', type=float, default=2.0,
+                              help='seconds a file must stay unchanged before it is converted')
+    watch_parser.add_argument('--poll', action='store_true',
+                              help='rescan periodically instead of using inotify')
+    watch_parser.add_argument('--poll-interval', type=float, default=5.0)
+    watch_parser.add_argument('--state', help='state index path (default: OUTPUT/.watch-state.json)')
+    add_conversion_arguments(watch_parser)
+    watch_parser.set_defaults(func=watch)
+    
+    soak_parser = commands.add_parser('soak', help='load-test a running server and check for leaks')
+    soak_parser.add_argument('url', nargs='?', default='http://127.0.0.1:8080')
+    soak_parser.add_argument('--duration', type=float, default=600, help='seconds to run')
+    soak_parser.add_argument('--concurrency', type=int, default=4, help='requests in flight')
+    soak_parser.add_argument('--video-share', type=float, default=0.3,
+                             help='fraction of requests that are videos')
+    soak_parser.add_argument('--fixtures', help='folder of inputs to use instead of generated ones')
+    soak_parser.add_argument('--fixture-count', type=int, default=4,
+                             help='images and videos to generate')
+    soak_parser.add_argument('--warmup', type=float,
+                             help='seconds before the resource baseline (default: a tenth, at most 60)')
+    soak_parser.add_argument('--sample-interval', type=float, default=10,
+                             help='seconds between /health samples')
+    soak_parser.add_argument('--timeout', type=float, default=600, help='per-request timeout')
+    soak_parser.add_argument('--report', help='also write the JSON summary here')
+    for name, default in SOAK_THRESHOLDS.items():
+        soak_parser.add_argument('--' + name.replace('_', '-'), type=type(default),
+                                 help=f'limit the run fails past (default {default})')
+    soak_parser.set_defaults(func=soak)
+    
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(['serve'])
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
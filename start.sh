@@ -13,6 +13,12 @@ if ! command -v ffmpeg &> /dev/null; then
     exit 1
 fi
 
+# Check which encoders and filters this FFmpeg build has (cached per binary)
+if ! python3 converter.py probe > /dev/null; then
+    echo "Warning: this FFmpeg build cannot convert videos or images."
+    echo "Run 'python3 converter.py probe' for details."
+fi
+
 # Start the converter
 echo "Starting Web Media Converter..."
 echo "Opening browser at http://127.0.0.1:8080"
@@ -0,0 +1,7 @@
+import os
+import sys
+from pathlib import Path
+
+# converter reads its settings at import; keep the job history out of the checkout
+os.environ.setdefault('CONVERTER_HISTORY_DB', '')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,52 @@
+import io
+import os
+import zipfile
+
+import converter
+
+
+def test_stream_zip(tmp_path):
+    first = tmp_path / 'first.webm'
+    first.write_bytes(os.urandom(10000))
+    second = tmp_path / 'second.webp'
+    second.write_bytes(b'')
+    
+    chunks = list(converter.stream_zip([('clips/first.webm', first), ('second.webp', second)],
+                                       chunk_size=1000))
+    # Entries are streamed a chunk at a time rather than buffered whole
+    assert len(chunks) > 10
+    assert max(map(len, chunks)) < 2000
+    
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ['clips/first.webm', 'second.webp']
+        assert archive.read('clips/first.webm') == first.read_bytes()
+        assert archive.read('second.webp') == b''
+        assert {info.compress_type for info in archive.infolist()} == {zipfile.ZIP_STORED}
+
+
+def store(tmp_path, name, data):
+    path = tmp_path / f'{data.hex()}{os.path.splitext(name)[1]}'
+    path.write_bytes(data)
+    with converter.app.test_request_context():
+        return converter.store_result(path, name)
+
+
+def test_archive_endpoint_numbers_duplicate_names(tmp_path):
+    ids = [store(tmp_path, 'photo.webp', b'one')['id'],
+           store(tmp_path, 'photo.webp', b'two')['id'],
+           store(tmp_path, 'clip.webm', b'three')['id']]
+    client = converter.app.test_client()
+    response = client.post('/results/archive', data={'ids': ','.join(ids + ['expired']), 'name': 'batch'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    assert 'batch.zip' in response.headers['Content-Disposition']
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.namelist() == ['photo.webp', 'photo (2).webp', 'clip.webm']
+        assert archive.read('photo (2).webp') == b'two'
+    response.close()
+
+
+def test_archive_endpoint_without_results():
+    response = converter.app.test_client().post('/results/archive', data={'ids': 'missing'})
+    assert response.status_code == 404
@@ -0,0 +1,144 @@
+import threading
+
+import pytest
+
+import converter
+
+
+@pytest.fixture(params=['directory', 'sqlite'])
+def broker_spec(request, tmp_path):
+    if request.param == 'sqlite':
+        return f"sqlite:{tmp_path / 'queue.db'}"
+    return str(tmp_path / 'queue')
+
+
+@pytest.fixture
+def upload(tmp_path):
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(b'input bytes')
+    return path
+
+
+def test_claim_finish_collect(broker_spec, upload, tmp_path):
+    broker = converter.open_broker(broker_spec)
+    job_id = broker.submit({'kind': 'video', 'quality': 30}, upload)
+    
+    job_id_claimed, job, input_path = broker.claim('w1', tmp_path)
+    assert job_id_claimed == job_id
+    assert job == {'kind': 'video', 'quality': 30}
+    assert input_path.read_bytes() == b'input bytes'
+    assert broker.claim('w2', tmp_path) is None
+    assert broker.collect(job_id, tmp_path) is None
+    
+    output = tmp_path / 'result.webm'
+    output.write_bytes(b'output bytes')
+    broker.finish(job_id, {'quality': 30, 'files': ['output']}, {'output': output})
+    result, files = broker.collect(job_id, tmp_path)
+    assert result['quality'] == 30
+    assert files['output'].read_bytes() == b'output bytes'
+    assert files['output'].suffix == '.webm'
+    assert broker.collect(job_id, tmp_path) is None
+
+
+def test_release_requeues(broker_spec, upload, tmp_path):
+    broker = converter.open_broker(broker_spec)
+    job_id = broker.submit({}, upload)
+    broker.claim('w1', tmp_path)
+    broker.release(job_id)
+    assert broker.claim('w2', tmp_path)[0] == job_id
+
+
+def test_expired_lease_requeues(broker_spec, upload, tmp_path, monkeypatch):
+    broker = converter.open_broker(broker_spec)
+    job_id = broker.submit({}, upload)
+    broker.claim('w1', tmp_path)
+    broker.heartbeat(job_id)
+    assert broker.claim('w2', tmp_path) is None
+    
+    monkeypatch.setattr(converter, 'BROKER_LEASE', -1)
+    assert broker.claim('w2', tmp_path)[0] == job_id
+
+
+def test_cancelled_job_is_not_claimed(broker_spec, upload, tmp_path):
+    broker = converter.open_broker(broker_spec)
+    job_id = broker.submit({}, upload)
+    broker.cancel(job_id)
+    assert broker.claim('w1', tmp_path) is None
+    assert broker.collect(job_id, tmp_path) is None
+
+
+def test_concurrent_workers_claim_each_job_once(broker_spec, upload, tmp_path):
+    submitted = {converter.open_broker(broker_spec).submit({'n': n}, upload) for n in range(100)}
+    claimed = []
+    errors = []
+    
+    def worker(name):
+        # Each worker opens its own broker, as separate processes would
+        broker = converter.open_broker(broker_spec)
+        workdir = tmp_path / name
+        workdir.mkdir()
+        try:
+            while True:
+                job = broker.claim(name, workdir)
+                if job is None:
+                    return
+                claimed.append(job[0])
+        except Exception as e:
+            errors.append(e)
+    
+    threads = [threading.Thread(target=worker, args=(f'w{n}',)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert errors == []
+    assert sorted(claimed) == sorted(submitted)
+
+
+def test_capacity_counts_jobs_and_live_worker_slots(broker_spec, upload, tmp_path, monkeypatch):
+    broker = converter.open_broker(broker_spec)
+    assert broker.capacity() == (0, 0)
+    broker.announce('host-a:1', 2)
+    broker.announce('host-b:1', 3)
+    broker.announce('host-b:1', 4)
+    for _ in range(3):
+        broker.submit({}, upload)
+    broker.claim('host-a:1', tmp_path)
+    assert broker.capacity() == (3, 6)
+    
+    monkeypatch.setattr(converter, 'BROKER_LEASE', -1)
+    assert broker.capacity() == (3, 0)
+
+
+def test_admission_follows_broker_capacity(broker_spec, upload, monkeypatch):
+    broker = converter.open_broker(broker_spec)
+    monkeypatch.setattr(converter, 'BROKER', broker_spec)
+    monkeypatch.setattr(converter, '_broker', broker)
+    monkeypatch.setattr(converter, 'MAX_ACTIVE_JOBS', -1)
+    monkeypatch.setattr(converter, 'MAX_QUEUE_WAIT', 0)
+    assert converter.admission_check()[0] == 'no workers attached to the broker'
+    
+    broker.announce('host-a:1', 1)
+    assert converter.admission_check() is None
+    broker.submit({}, upload)
+    broker.submit({}, upload)
+    assert converter.admission_check()[0] == 'too many active conversions'
+    broker.announce('host-b:1', 1)
+    assert converter.admission_check() is None
+
+
+def test_finish_after_cancel_stores_nothing(broker_spec, upload, tmp_path):
+    broker = converter.open_broker(broker_spec)
+    job_id = broker.submit({}, upload)
+    broker.claim('w1', tmp_path)
+    broker.cancel(job_id)
+    output = tmp_path / 'result.webm'
+    output.write_bytes(b'output bytes')
+    broker.finish(job_id, {'files': ['output']}, {'output': output})
+    
+    assert broker.collect(job_id, tmp_path) is None
+    if isinstance(broker, converter.SQLiteBroker):
+        assert broker.db().execute('SELECT COUNT(*) FROM files').fetchone()[0] == 0
+    else:
+        assert not any((tmp_path / 'queue' / 'done').iterdir())
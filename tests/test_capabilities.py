@@ -0,0 +1,83 @@
+import subprocess
+
+import pytest
+
+import converter
+
+ENCODERS = """Encoders:
+ V..... = Video
+ A..... = Audio
+ S..... = Subtitle
+ .F.... = Frame-level multithreading
+ ..S... = Slice-level multithreading
+ ...X.. = Codec is experimental
+ ....B. = Supports draw_horiz_band
+ .....D = Supports direct rendering method 1
+ ------
+ V....D libvpx-vp9           libvpx VP9 (codec vp9)
+ V....D libwebp              libwebp WebP image (codec webp)
+ A....D libopus              libopus Opus (codec opus)
+"""
+
+FILTERS = """Filters:
+  T.. = Timeline support
+  .S. = Slice threading
+  ..C = Command support
+  A = Audio input/output
+  V = Video input/output
+  N = Dynamic number and/or type of input/output
+  | = Source or sink filter
+ TS. scale             V->V       Scale the input video size.
+ T.. ssim              VV->V      Calculate the SSIM between two video streams.
+"""
+
+
+@pytest.fixture
+def ffmpeg(monkeypatch, tmp_path):
+    """Fake ffmpeg whose probe output (or exception) the test sets"""
+    outputs = {'-version': 'ffmpeg version 6.1 Copyright', '-encoders': ENCODERS, '-filters': FILTERS}
+    binary = tmp_path / 'ffmpeg'
+    binary.write_bytes(b'fake')
+    
+    def run(cmd, **kwargs):
+        output = outputs[cmd[-1]]
+        if isinstance(output, Exception):
+            raise output
+        return subprocess.CompletedProcess(cmd, 0, output, '')
+    
+    monkeypatch.setattr(converter.subprocess, 'run', run)
+    monkeypatch.setattr(converter.shutil, 'which',
+                        lambda name: str(binary) if name == 'ffmpeg' else None)
+    monkeypatch.setattr(converter, 'CAPABILITY_CACHE', str(tmp_path / 'capabilities.json'))
+    monkeypatch.setattr(converter, '_capabilities', None)
+    return outputs
+
+
+def test_probe_skips_the_legend(ffmpeg):
+    capabilities = converter.ffmpeg_capabilities()
+    assert capabilities['version'] == '6.1'
+    assert capabilities['encoders'] == ['libopus', 'libvpx-vp9', 'libwebp']
+    assert capabilities['filters'] == ['scale', 'ssim']
+    assert converter.engine_available('vp9')
+    assert not converter.engine_available('av1-svt')
+    assert converter.missing_filters({'scale', 'tile'}) == {'tile'}
+
+
+def test_failed_probe_allows_engines_and_is_retried(ffmpeg, monkeypatch):
+    ffmpeg['-version'] = subprocess.TimeoutExpired(['ffmpeg'], 30)
+    capabilities = converter.ffmpeg_capabilities()
+    assert capabilities['encoders'] == []
+    assert converter.engine_available('av1-svt')
+    assert converter.missing_filters({'tile'}) == set()
+    
+    ffmpeg['-version'] = 'ffmpeg version 6.1 Copyright'
+    assert converter.ffmpeg_capabilities()['encoders'] == []
+    monkeypatch.setattr(converter, '_capabilities_expire', 0)
+    assert converter.ffmpeg_capabilities()['encoders'] == ['libopus', 'libvpx-vp9', 'libwebp']
+    assert not converter.engine_available('av1-svt')
+
+
+def test_engines_need_an_ffmpeg_binary(monkeypatch):
+    monkeypatch.setattr(converter.shutil, 'which', lambda name: None)
+    monkeypatch.setattr(converter, '_capabilities', None)
+    assert not converter.engine_available('vp9')
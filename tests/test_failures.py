@@ -0,0 +1,114 @@
+import signal
+
+import pytest
+
+import converter
+
+
+@pytest.mark.parametrize('stderr, failure', [
+    ('av_interleaved_write_frame(): No space left on device', 'disk-full'),
+    ('x265 [error]: Cannot allocate memory', 'out-of-memory'),
+    ('[vost#0:0] Unknown encoder libsvtav1', 'missing-encoder'),
+    ('Decoder (codec hevc) not found for input stream #0:0', 'unsupported-codec'),
+    ('clip.mp4: Invalid data found when processing input', 'corrupt-input'),
+    ('[mov,mp4,m4a] moov atom not found', 'corrupt-input'),
+    ('Conversion failed!', None),
+])
+def test_classify_failure(stderr, failure):
+    assert converter.classify_failure('frame=  10\n' + stderr, 1) == (failure, 'frame=  10\n' + stderr)
+
+
+def test_classify_failure_by_signal():
+    assert converter.classify_failure('', -signal.SIGKILL)[0] == 'out-of-memory'
+    assert converter.classify_failure('', -signal.SIGTERM)[0] is None
+    assert converter.classify_failure(None, None) == (None, '')
+
+
+def test_classify_failure_reads_the_tail():
+    stderr = '\n'.join(['Invalid data found when processing input'] + ['frame'] * 30)
+    failure, tail = converter.classify_failure(stderr, 1)
+    assert failure is None
+    assert tail.splitlines() == ['frame'] * converter.FAILURE_TAIL_LINES
+
+
+@pytest.fixture
+def job(tmp_path):
+    return {'input': tmp_path / 'clip.mp4', 'output': tmp_path / 'clip.webm', 'speed': 'balanced'}
+
+
+def test_retry_steps_run_once(job):
+    retries = []
+    engine = converter.ENGINES['vp9']
+    assert converter.plan_retry('corrupt-input', job, engine, retries) == ('tolerant-decode', engine)
+    assert job['tolerant'] is True
+    assert converter.plan_retry('corrupt-input', job, engine, retries) == (None, engine)
+    assert retries == ['tolerant-decode']
+
+
+def test_unsupported_codec_is_not_retried(job):
+    retries = []
+    engine = converter.ENGINES['vp9']
+    assert converter.plan_retry('unsupported-codec', job, engine, retries) == (None, engine)
+    assert converter.plan_retry(None, job, engine, retries) == (None, engine)
+    assert retries == []
+
+
+def test_downscale_halves_the_size(job, monkeypatch):
+    monkeypatch.setattr(converter, 'probe_media', lambda path: {'width': 1921, 'height': 1080})
+    engine = converter.ENGINES['vp9']
+    assert converter.plan_retry('out-of-memory', job, engine, [])[0] == 'downscale'
+    assert job['scale'] == (960, 540)
+    
+    job['scale'] = (60, 40)
+    assert converter.plan_retry('out-of-memory', job, engine, [])[0] is None
+
+
+def test_other_engine(job, monkeypatch):
+    monkeypatch.setattr(converter, 'engine_available', lambda name: name != 'av1-svt')
+    retries = []
+    step, engine = converter.plan_retry('missing-encoder', job, converter.ENGINES['av1-svt'], retries)
+    assert (step, engine['name']) == ('other-engine', 'vp9')
+    
+    monkeypatch.setattr(converter, 'engine_available', lambda name: False)
+    step, engine = converter.plan_retry('missing-encoder', job, converter.ENGINES['av1-svt'], [])
+    assert (step, engine['name']) == (None, 'av1-svt')
+
+
+def test_faster_speed(job):
+    engine = converter.ENGINES['vp9']
+    assert converter.plan_retry('timeout', job, engine, [])[0] == 'faster-speed'
+    assert job['speed'] == converter.SPEEDS[0]
+    assert converter.plan_retry('timeout', job, engine, [])[0] is None
+
+
+def test_free_space(job, monkeypatch):
+    monkeypatch.setattr(converter, 'DISK_FULL_WAIT', 0)
+    assert converter.plan_retry('disk-full', job, converter.ENGINES['vp9'], [])[0] == 'free-space'
+
+
+@pytest.mark.parametrize('failure, status', [
+    ('corrupt-input', 422),
+    ('unsupported-codec', 415),
+    ('missing-encoder', 500),
+    ('disk-full', 507),
+    ('interrupted', 503),
+    (None, 500),
+])
+def test_conversion_error_status(failure, status):
+    error = converter.ConversionError('Conversion failed', failure)
+    error.retries = ['tolerant-decode']
+    body, code = converter.conversion_error(error)
+    assert code == status
+    assert body == {'error': 'Conversion failed', 'failure': failure, 'retries': ['tolerant-decode']}
+
+
+def test_measure_quality_runs_as_a_job(monkeypatch):
+    jobs = []
+    
+    def run_job(cmd, job_class, timeout=300, **kwargs):
+        jobs.append(job_class)
+        return converter.subprocess.CompletedProcess(cmd, 0, '', 'SSIM Y:0.99 All:0.981 (17.2)')
+    
+    monkeypatch.setattr(converter, 'run_job', run_job)
+    assert converter.measure_quality('trial.webm', 'sample.mkv', 'ssim', 'video') == 0.981
+    assert jobs == ['video']
@@ -0,0 +1,128 @@
+import io
+
+import pytest
+
+import converter
+
+
+@pytest.fixture
+def probe(monkeypatch):
+    def set_probe(width, height, codec):
+        monkeypatch.setattr(converter, 'probe_media',
+                            lambda path: {'width': width, 'height': height, 'codec': codec})
+    return set_probe
+
+
+def budget_pixels():
+    return converter.IMAGE_MEMORY_LIMIT_MB * 1024 * 1024 // (4 * converter.IMAGE_FRAME_COPIES)
+
+
+def test_small_image_is_decoded_as_is(probe):
+    probe(1920, 1080, 'png')
+    assert converter.plan_image_decode('photo.png') == {'lowres': 0, 'scale': None, 'job_class': 'image'}
+
+
+def test_unknown_size_is_decoded_as_is(probe):
+    probe(None, None, 'png')
+    assert converter.plan_image_decode('photo.png')['scale'] is None
+
+
+def test_too_many_pixels_is_refused(probe):
+    probe(20000, 20000, 'png')
+    with pytest.raises(converter.ImageTooLarge, match='megapixels'):
+        converter.plan_image_decode('photo.png')
+
+
+def test_large_png_is_scaled_in_the_large_class(probe):
+    probe(12000, 9000, 'png')
+    plan = converter.plan_image_decode('scan.png')
+    assert plan['lowres'] == 0
+    assert plan['job_class'] == 'image-large'
+    width, height = plan['scale']
+    assert width * height <= budget_pixels()
+    assert width / height == pytest.approx(12000 / 9000, rel=0.01)
+
+
+def test_large_jpeg_decodes_shrunk(probe):
+    probe(12000, 9000, 'mjpeg')
+    plan = converter.plan_image_decode('photo.jpg')
+    assert plan['job_class'] == 'image'
+    assert plan['lowres'] == 1
+    # -lowres must not shrink below the planned output
+    assert 12000 / 2 ** plan['lowres'] >= plan['scale'][0]
+
+
+def test_large_jpeg_for_cwebp_decodes_full(probe):
+    probe(12000, 9000, 'mjpeg')
+    plan = converter.plan_image_decode('photo.jpg', full_decode=True)
+    assert plan['lowres'] == 0
+    assert plan['job_class'] == 'image-large'
+    assert converter.uses_cwebp(converter.ENGINES['webp-near-lossless'])
+    assert not converter.uses_cwebp(converter.ENGINES['webp-auto'])
+
+
+def test_wide_image_fits_webp_limits(probe):
+    probe(40000, 500, 'png')
+    width, height = converter.plan_image_decode('panorama.png')['scale']
+    assert width <= converter.WEBP_MAX_DIMENSION
+    assert height == 204
+
+
+def test_webp_auto_trials_share_one_decode(tmp_path, monkeypatch):
+    monkeypatch.setattr(converter, 'probe_media',
+                        lambda path: {'width': 12000, 'height': 9000, 'pix_fmt': 'rgb24'})
+    runs = []
+    
+    def run_job(cmd, job_class, timeout=None, **kwargs):
+        runs.append((cmd, job_class))
+        output = converter.Path(cmd[-1])
+        output.write_bytes(b'x' * (100 if 'lossless' in output.name else 95))
+        return converter.subprocess.CompletedProcess(cmd, 0, '', '')
+    
+    monkeypatch.setattr(converter, 'run_job', run_job)
+    job = {'input': tmp_path / 'scan.png', 'output': tmp_path / 'scan.webp', 'quality': 30,
+           'speed': 'balanced', 'lowres': 0, 'scale': (5461, 4095), 'job_class': 'image-large'}
+    assert converter.prepare_webp_auto(job) == {'mode': 'lossless'}
+    
+    (decode, decode_class), *trials = runs
+    assert decode_class == 'image-large'
+    assert str(job['input']) in decode
+    assert len(trials) == 2
+    for cmd, job_class in trials:
+        assert job_class == 'image'
+        assert str(job['input']) not in cmd
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize('width, dpi, sizes', [
+    (None, None, (None, None)),
+    ('', '', (None, None)),
+    ('2048', '144', (2048, 144)),
+    (800, None, (800, None)),
+])
+def test_parse_svg_size(width, dpi, sizes):
+    assert converter.parse_svg_size(width, dpi) == sizes
+
+
+@pytest.mark.parametrize('width, dpi, message', [
+    ('0', None, 'SVG width must be a positive'),
+    (None, '0', 'SVG DPI must be a positive'),
+    ('-5', None, 'SVG width must be a positive'),
+    ('1.5', None, 'SVG width must be a positive'),
+    (str(converter.SVG_MAX_WIDTH + 1), None, 'at most'),
+])
+def test_parse_svg_size_rejects(width, dpi, message):
+    with pytest.raises(ValueError, match=message):
+        converter.parse_svg_size(width, dpi)
+
+
+@pytest.mark.parametrize('field, value', [('svg_width', '0'), ('svg_dpi', '0'), ('svg_width', '99999')])
+def test_convert_rejects_bad_svg_size(field, value, monkeypatch):
+    monkeypatch.setattr(converter, 'admission_check', lambda: None)
+    monkeypatch.setattr(converter, 'select_engine', lambda *args, **kwargs: converter.ENGINES['webp'])
+    response = converter.app.test_client().post(
+        '/convert', data={'file': (io.BytesIO(b'<svg/>'), 'logo.svg'), field: value},
+        content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert 'SVG' in response.get_json()['error']
+    assert list(converter.Path(converter.UPLOAD_FOLDER).glob('*logo.svg')) == []
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+import converter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(converter.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture(autouse=True)
+def quotas(monkeypatch):
+    monkeypatch.setattr(converter, 'QUOTA_ENCODE_SECONDS', 100.0)
+    monkeypatch.setattr(converter, 'QUOTA_MB', 0.0)
+    monkeypatch.setattr(converter, 'QUOTA_WINDOW', 100.0)
+    monkeypatch.setattr(converter, 'QUOTA_DB', '')
+    monkeypatch.setattr(converter, 'quota_buckets', {})
+    monkeypatch.setattr(converter, 'quota_local', threading.local())
+
+
+def test_overdraw_waits_until_refilled(clock):
+    assert converter.quota_status('ip:a')['seconds'] == 100
+    converter.charge_quota('ip:a', seconds=150)
+    assert converter.quota_status('ip:a')['seconds'] == -50
+    assert converter.quota_wait('ip:a') == pytest.approx(50)
+    
+    clock[0] += 30
+    assert converter.quota_wait('ip:a') == pytest.approx(20)
+    clock[0] += 30
+    assert converter.quota_status('ip:a')['seconds'] == pytest.approx(10)
+    assert converter.quota_wait('ip:a') is None
+
+
+def test_refill_stops_at_limit(clock):
+    converter.charge_quota('ip:a', seconds=40)
+    clock[0] += 1000
+    assert converter.quota_status('ip:a')['seconds'] == 100
+
+
+def test_clients_have_separate_buckets(clock):
+    converter.charge_quota('ip:a', seconds=100)
+    assert converter.quota_wait('ip:a') is not None
+    assert converter.quota_wait('ip:b') is None
+
+
+def test_disabled_bucket_is_not_enforced(clock):
+    converter.charge_quota('ip:a', size=10 ** 12)
+    assert converter.quota_wait('ip:a') is None
+    assert converter.quota_limits()['bytes'] == 0
+
+
+def test_buckets_persist(clock, tmp_path, monkeypatch):
+    monkeypatch.setattr(converter, 'QUOTA_DB', str(tmp_path / 'quota.db'))
+    converter.charge_quota('ip:a', seconds=70)
+    monkeypatch.setattr(converter, 'quota_buckets', {})
+    monkeypatch.setattr(converter, 'quota_local', threading.local())
+    assert converter.quota_status('ip:a')['seconds'] == 30
+
+
+def test_client_identity(monkeypatch):
+    monkeypatch.setattr(converter, 'API_KEYS', {'secret'})
+    headers = {'X-API-Key': 'secret'}
+    with converter.app.test_request_context(headers=headers, environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+        client = converter.quota_client()
+    assert client.startswith('key:') and 'secret' not in client
+    with converter.app.test_request_context(headers={'X-API-Key': 'guess'},
+                                            environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+        assert converter.quota_client() == 'ip:10.0.0.1'
+
+
+def test_exhausted_client_gets_429(clock, monkeypatch):
+    monkeypatch.setattr(converter, 'admission_check', lambda: None)
+    converter.charge_quota('ip:127.0.0.1', seconds=120)
+    response = converter.app.test_client().post('/convert')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '20'
+    assert response.headers['X-Quota-Encode-Seconds-Remaining'] == '0'
+    assert response.headers['X-Quota-Encode-Seconds-Limit'] == '100'
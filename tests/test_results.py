@@ -0,0 +1,47 @@
+import json
+
+from werkzeug.wsgi import FileWrapper
+
+import converter
+
+
+def test_traced_file_response_writes_trace(tmp_path, monkeypatch):
+    trace_file = tmp_path / 'traces.jsonl'
+    monkeypatch.setattr(converter, 'TRACE_FILE', str(trace_file))
+    output = tmp_path / 'out.webp'
+    output.write_bytes(b'RIFF' + b'\0' * 100)
+    
+    def convert_request(trace):
+        with trace.span('encode'):
+            stored = converter.store_result(output, 'photo.webp')
+        return converter.send_result(stored)
+    
+    monkeypatch.setattr(converter, 'convert_request', convert_request)
+    client = converter.app.test_client()
+    # A server-provided file_wrapper is what made werkzeug skip close callbacks
+    response = client.post('/convert', headers={'X-Trace': '1'},
+                           environ_base={'wsgi.file_wrapper': FileWrapper})
+    assert response.status_code == 200
+    assert len(response.data) == 104
+    response.close()
+    
+    record = json.loads(trace_file.read_text())
+    assert record['trace_id'] == response.headers['X-Trace-Id']
+    assert record['status'] == 200
+    assert [span['name'] for span in record['spans']] == ['encode', 'send']
+
+
+def test_result_range_request(tmp_path):
+    output = tmp_path / 'out.webm'
+    output.write_bytes(bytes(range(200)))
+    with converter.app.test_request_context():
+        stored = converter.store_result(output, 'clip.webm')
+    
+    client = converter.app.test_client()
+    response = client.get(f"/results/{stored['id']}", headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.data == bytes(range(10, 20))
+    assert response.mimetype == 'video/webm'
+    response.close()
+    
+    assert client.get('/results/missing').status_code == 404
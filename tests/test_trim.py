@@ -0,0 +1,67 @@
+import pytest
+
+import converter
+
+
+@pytest.mark.parametrize('value, seconds', [
+    (None, None),
+    ('', None),
+    ('90', 90),
+    ('90.5', 90.5),
+    ('1:30', 90),
+    ('00:01:30.5', 90.5),
+    ('1:00:00', 3600),
+    (12, 12),
+])
+def test_parse_timestamp(value, seconds):
+    assert converter.parse_timestamp(value) == seconds
+
+
+@pytest.mark.parametrize('value', ['abc', '-5', '1:-30', 'nan', 'inf', '1:30:', '1:2:3:4', '1e3'])
+def test_parse_timestamp_rejects(value):
+    with pytest.raises(ValueError, match='Invalid time'):
+        converter.parse_timestamp(value)
+
+
+def test_trim_range():
+    assert converter.trim_range('video') == (None, None)
+    assert converter.trim_range('image', '', None, '') == (None, None)
+    assert converter.trim_range('video', '10') == (10, None)
+    assert converter.trim_range('video', '0:10', '0:25') == (10, 15)
+    assert converter.trim_range('video', None, '30') == (None, 30)
+    assert converter.trim_range('video', '5', None, '2.5') == (5, 2.5)
+
+
+@pytest.mark.parametrize('kind, start, end, duration, message', [
+    ('image', '1', None, None, 'only available for videos'),
+    ('video', '1', '5', '2', 'either an end time or a duration'),
+    ('video', '10', '10', None, 'End time must be after'),
+    ('video', '10', '5', None, 'End time must be after'),
+    ('video', None, None, '0', 'Duration must be positive'),
+])
+def test_trim_range_rejects(kind, start, end, duration, message):
+    with pytest.raises(ValueError, match=message):
+        converter.trim_range(kind, start, end, duration)
+
+
+def test_probe_runs_once_per_file(tmp_path, monkeypatch):
+    calls = []
+    
+    def run(cmd, **kwargs):
+        calls.append(cmd)
+        return converter.subprocess.CompletedProcess(
+            cmd, 0, '{"streams": [{"width": 640, "height": 360, "avg_frame_rate": "30/1"}], '
+                    '"format": {"duration": "12.5"}}', '')
+    
+    monkeypatch.setattr(converter.subprocess, 'run', run)
+    clip = tmp_path / 'clip.mp4'
+    clip.write_bytes(b'one')
+    assert converter.clip_length(clip, 2.5) == 10
+    assert converter.clip_length(clip, None, 4) == 4
+    assert converter.probe_media(clip)['fps'] == 30
+    assert len(calls) == 1
+    
+    # A rewritten file is probed again
+    clip.write_bytes(b'other')
+    converter.probe_media(clip)
+    assert len(calls) == 2